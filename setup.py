@@ -6,7 +6,8 @@ minimum_requirements = [
     "Pillow",
     "pandas",
     "boto3",
-    "matplotlib"
+    "matplotlib",
+    "orjson"
 ]
 
 full_requirements = minimum_requirements + [
@@ -14,7 +15,8 @@ full_requirements = minimum_requirements + [
 ]
 
 test_requirements = minimum_requirements + [
-    "pytest"
+    "pytest",
+    "moto>=5"
 ]
 
 version_file_path = (
@@ -1,19 +1,78 @@
-from typing import List, Tuple, Union
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import hashlib
+import io
 import json
-import copy
+import functools
+import operator
+import os
+import queue
+import threading
+import time
+import uuid
 import warnings
 
+import orjson
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 from PIL import Image
 from PIL import ImageFile
 
-from open_dataset_tools.aws_utils import get_public_boto3_client
+from open_dataset_tools.aws_utils import (
+    get_public_boto3_client,
+    get_transfer_config
+)
 
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# size (in bytes) of the chunks read from disk when computing checksums
+_HASH_CHUNK_SIZE = 1 << 22
+
+# number of chunks that may be read ahead of the one being hashed
+_HASH_READ_AHEAD = 4
+
+# if this environment variable is set to '1', files that have already
+# been downloaded and verified are never checked against S3 again
+# (the published data does not change); see _get_aws_file
+_SKIP_REMOTE_CHECK_ENV_VAR = 'ABA_SKIP_REMOTE_CHECK'
+
+# the (verified) contents of the metadata files most recently loaded by
+# this process, keyed on (bucket_name, s3_key, etag); see
+# download_s3_metadata_file and clear_metadata_cache
+_METADATA_CACHE_SIZE = 16
+_metadata_cache: Dict[Tuple[str, str, str], bytes] = {}
+_metadata_cache_lock = threading.Lock()
+
+# TIFFs larger than this (in bytes) are buffered in a temporary file
+# rather than in memory while they are being cropped
+_MAX_IN_MEMORY_IMAGE_SIZE = 256 * 1024 * 1024
+
+# minimum size (in bytes) of the byte-range requests made when reading
+# the header of a TIFF in S3
+_RANGE_READ_SIZE = 1 << 20
+
+
+def _head_aws_file(
+    fname: str, s3_client, bucket_name='allen-mouse-brain-atlas'
+) -> Tuple[str, int]:
+    """
+    Get and return the ETag (str) and size in bytes (int) of a file
+    in AWS
+    """
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=fname)
+    except ClientError as err:
+        if err.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        msg = '\nquerying bucket for %s ' % fname
+        msg += 'returned 0 results\n'
+        raise RuntimeError(msg) from err
+
+    return response['ETag'].strip('"'), response['ContentLength']
+
 
 def _get_aws_md5(
     fname: str, s3_client, bucket_name='allen-mouse-brain-atlas'
@@ -21,16 +80,54 @@ def _get_aws_md5(
     """
     Get and return the md5 checksum (str) of a file in AWS
     """
-    # get the md5sum of the section_data_sets.json file
-    # to determine if the file must be downloaded
-    obj_list = s3_client.list_objects(Bucket=bucket_name,
-                               Prefix=fname)['Contents']
-    if len(obj_list) != 1:
-        msg = '\nquerying bucket for %s ' % fname
-        msg += 'returned %d results\n' % len(obj_list)
-        raise RuntimeError(msg)
+    # get the md5sum of the file from its ETag to determine
+    # if the file must be downloaded
+    return _head_aws_file(fname, s3_client, bucket_name=bucket_name)[0]
+
+
+def _is_md5_etag(etag: str) -> bool:
+    """
+    Return True if etag is the md5 checksum of the file's contents.
+    That is not the case for files uploaded in several parts, whose
+    ETags take the form '<checksum of the parts' checksums>-<n_parts>'.
+    """
+    return '-' not in etag
+
+
+def _md5(data: bytes = b''):
+    """
+    Return a new md5 hash object. The checksums here only verify
+    downloads (md5 is what S3 ETags use), so the object is marked as not
+    used for security; on FIPS-enabled systems this keeps md5 available
+    and skips the FIPS self-checks.
+    """
+    try:
+        return hashlib.md5(data, usedforsecurity=False)
+    except TypeError:
+        # python < 3.9 does not accept usedforsecurity
+        return hashlib.md5(data)
 
-    return obj_list[0]['ETag'].replace('"','')
+
+def _read_chunks(fname: Path, empty: queue.Queue, full: queue.Queue):
+    """
+    Read fname into the buffers taken from the empty queue and put
+    (buffer, n_bytes) on the full queue. An n_bytes of 0 marks the end
+    of the file; an exception raised while reading is put on the full
+    queue in place of the buffer. Stop early if None is taken from the
+    empty queue.
+    """
+    try:
+        with open(fname, 'rb', buffering=0) as in_file:
+            while True:
+                buf = empty.get()
+                if buf is None:
+                    return
+                n_bytes = in_file.readinto(buf)
+                full.put((buf, n_bytes))
+                if not n_bytes:
+                    return
+    except BaseException as err:
+        full.put((err, 0))
 
 
 def _compare_md5(fname: Path, target: str) -> bool:
@@ -39,13 +136,89 @@ def _compare_md5(fname: Path, target: str) -> bool:
     string specified by target. Return boolean result indicating if
     they are equal.
     """
-    md5_obj = hashlib.md5()
-    with open(fname, 'rb') as in_file:
-        for line in in_file:
-            md5_obj.update(line)
+    if (hasattr(hashlib, 'file_digest')
+            and fname.stat().st_size <= _HASH_CHUNK_SIZE):
+        # small files (most metadata) are not worth starting a reader
+        # thread for; hash them with the C-level reader on Python 3.11+
+        with open(fname, 'rb') as in_file:
+            return hashlib.file_digest(in_file, _md5).hexdigest() == target
+
+    md5_obj = _md5()
+    # read in large fixed-size chunks (rather than "lines", which are
+    # meaningless for binary files) so that hashlib gets buffers big
+    # enough to release the GIL and hash at streaming speed; the reading
+    # happens in a separate thread so that the disk is never idle while
+    # the previous chunk is being hashed (and vice versa)
+    empty = queue.Queue()
+    full = queue.Queue()
+    for _ in range(_HASH_READ_AHEAD):
+        empty.put(bytearray(_HASH_CHUNK_SIZE))
+
+    reader = threading.Thread(
+        target=_read_chunks, args=(fname, empty, full), daemon=True
+    )
+    reader.start()
+    try:
+        while True:
+            buf, n_bytes = full.get()
+            if isinstance(buf, BaseException):
+                raise buf
+            if not n_bytes:
+                break
+            with memoryview(buf) as view:
+                md5_obj.update(view[:n_bytes])
+            empty.put(buf)
+    finally:
+        # make sure the reader is not left waiting for a buffer
+        empty.put(None)
+        reader.join()
     return md5_obj.hexdigest() == target
 
 
+def _sidecar_path(local_filename: Path) -> Path:
+    """
+    Return the path of the sidecar file that records the ETag of
+    local_filename
+    """
+    return local_filename.with_name(local_filename.name + '.etag')
+
+
+def _write_sidecar(local_filename: Path, etag: str) -> None:
+    """
+    Record that local_filename, as it currently exists on disk, has
+    just been verified against the S3 ETag etag
+    """
+    file_stats = local_filename.stat()
+    sidecar = {
+        'etag': etag,
+        'size': file_stats.st_size,
+        'mtime_ns': file_stats.st_mtime_ns,
+        'checked': time.time()
+    }
+    with open(_sidecar_path(local_filename), 'w') as out_file:
+        json.dump(sidecar, out_file)
+
+
+def _read_sidecar(local_filename: Path) -> Optional[dict]:
+    """
+    Return the sidecar recorded for local_filename (a dict containing
+    the verified 'etag' and the time it was 'checked' against S3), or
+    None if there is no sidecar or the file has changed (size or mtime)
+    since the sidecar was written
+    """
+    try:
+        with open(_sidecar_path(local_filename), 'rb') as in_file:
+            sidecar = json.load(in_file)
+        file_stats = local_filename.stat()
+        if (sidecar['size'] != file_stats.st_size
+                or sidecar['mtime_ns'] != file_stats.st_mtime_ns
+                or not isinstance(sidecar['etag'], str)):
+            return None
+        return sidecar
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
 def _need_to_download(
     aws_key: str, local_filename: Path, s3_client,
     bucket_name='allen-mouse-brain-atlas'
@@ -71,7 +244,9 @@ def _need_to_download(
 
     A string containing the md5checksum of the file
     """
-    target_md5 = _get_aws_md5(aws_key, s3_client, bucket_name=bucket_name)
+    (target_md5, target_size) = _head_aws_file(
+        aws_key, s3_client, bucket_name=bucket_name
+    )
     must_download = False
     if not local_filename.exists():
         must_download = True
@@ -81,17 +256,37 @@ def _need_to_download(
                 '\n%s\nexists but is not a file' % local_filename
             )
 
-        if not _compare_md5(local_filename, target_md5):
-            must_download = True
+        # only re-hash the file if it has changed since it was last
+        # verified against this ETag
+        sidecar = _read_sidecar(local_filename)
+        if sidecar is None or sidecar['etag'] != target_md5:
+            if _is_md5_etag(target_md5):
+                is_valid = _compare_md5(local_filename, target_md5)
+            else:
+                # the checksum of a multipart upload cannot be
+                # reproduced locally; settle for comparing sizes
+                is_valid = local_filename.stat().st_size == target_size
+            if is_valid:
+                _write_sidecar(local_filename, target_md5)
+            else:
+                must_download = True
     return must_download, target_md5
 
 
 def _get_aws_file(aws_key, local_filename: Path, s3_client,
-                  bucket_name='allen-mouse-brain-atlas'):
+                  bucket_name='allen-mouse-brain-atlas',
+                  max_age: Optional[float] = None,
+                  chunks: Optional[List[bytes]] = None) -> bool:
     """
     Download the AWS file specified by bucket_name:aws_key to
     local_filename, but only if necessary
 
+    If local_filename is unchanged since it was last verified against
+    S3 (see _write_sidecar), this costs a single conditional GET that S3
+    answers with '304 Not Modified' when the local copy is current.
+    If max_age is given and the local copy was verified less than
+    max_age seconds ago, even that request is skipped.
+
     Parameters
     ----------
     aws_key is the Key of the file in S3
@@ -103,28 +298,319 @@ def _get_aws_file(aws_key, local_filename: Path, s3_client,
     bucket_name is the name of the S3 bucket where the file resides
     (Default: 'allen-mouse-brain-atlas')
 
+    max_age is the number of seconds for which a verified local copy is
+    trusted without checking S3 again (Default: None, i.e. always check,
+    unless the environment variable ABA_SKIP_REMOTE_CHECK is set to '1',
+    in which case verified local copies are always trusted)
+
+    chunks is an optional list; if the file is downloaded, its contents
+    are also appended to chunks so that the caller does not need to read
+    local_filename back from disk
+
     Returns
     -------
-    None; just download the file to the specified local_filename
+    True if the file was downloaded to local_filename; False if the
+    local copy was already up-to-date
     """
-    (must_download, target_md5) = _need_to_download(
-        aws_key, local_filename, s3_client,bucket_name=bucket_name
+    if max_age is None and os.environ.get(_SKIP_REMOTE_CHECK_ENV_VAR) == '1':
+        max_age = float('inf')
+
+    request = {'Bucket': bucket_name, 'Key': aws_key}
+    if local_filename.exists():
+        sidecar = _read_sidecar(local_filename)
+        if sidecar is not None:
+            if (max_age is not None
+                    and time.time() - sidecar.get('checked', 0) < max_age):
+                return False
+            request['IfNoneMatch'] = '"%s"' % sidecar['etag']
+        else:
+            # there is no record of this file having been verified;
+            # compare its checksum against the ETag in S3 instead
+            (must_download, target_md5) = _need_to_download(
+                aws_key, local_filename, s3_client, bucket_name=bucket_name
+            )
+            if not must_download:
+                return False
+
+    try:
+        response = s3_client.get_object(**request)
+    except ClientError as err:
+        error_code = err.response['Error']['Code']
+        if error_code == '304':
+            # local_filename is up-to-date; record when we last checked
+            _write_sidecar(local_filename, sidecar['etag'])
+            return False
+        if error_code in ('404', 'NoSuchKey'):
+            msg = '\nquerying bucket for %s ' % aws_key
+            msg += 'returned 0 results\n'
+            raise RuntimeError(msg) from err
+        raise
+
+    print('Downloading %s' % aws_key)
+    target_md5 = response['ETag'].strip('"')
+
+    # compute the checksum while the data streams in so the file never
+    # has to be read back from disk; only move the file into place once
+    # it has been verified so that a failed download cannot leave a
+    # corrupt local_filename behind
+    md5_obj = _md5()
+    n_bytes = 0
+    tmp_filename = local_filename.with_name(
+        '%s.%s.part' % (local_filename.name, uuid.uuid4().hex)
     )
+    try:
+        with open(tmp_filename, 'xb') as out_file:
+            for chunk in response['Body'].iter_chunks(_HASH_CHUNK_SIZE):
+                md5_obj.update(chunk)
+                out_file.write(chunk)
+                n_bytes += len(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+
+        if _is_md5_etag(target_md5):
+            if md5_obj.hexdigest() != target_md5:
+                msg = '\nDownloaded %s; ' % aws_key
+                msg += 'md5 checksum != %s\n' % target_md5
+                raise RuntimeError(msg)
+        elif n_bytes != response['ContentLength']:
+            # the ETag of a multipart upload is not an md5 checksum
+            msg = '\nDownloaded %s; ' % aws_key
+            msg += 'size %d != %d\n' % (n_bytes, response['ContentLength'])
+            raise RuntimeError(msg)
 
-    if must_download:
-        print('Downloading %s' % aws_key)
-        s3_client.download_file(
-            Bucket=bucket_name,
-            Key=aws_key,
-            Filename=str(local_filename)
+        os.replace(tmp_filename, local_filename)
+    finally:
+        if tmp_filename.exists():
+            tmp_filename.unlink()
+
+    _write_sidecar(local_filename, target_md5)
+
+    return True
+
+
+def _restrict_tiles(img: Image.Image, box: Tuple[int, int, int, int]):
+    """
+    Drop the strips/tiles of a not-yet-loaded PIL image that do not
+    overlap box = (x0, y0, x1, y1), so that a subsequent crop to box only
+    reads and decodes the part of the file it needs.
+
+    This only has an effect on uncompressed striped or tiled TIFFs; PIL
+    decodes compressed TIFFs (via libtiff) as a single tile covering the
+    whole image, which always overlaps box and is therefore kept.
+    """
+    x0, y0, x1, y1 = box
+    img.tile = [
+        tile for tile in img.tile
+        if tile[1][0] < x1 and tile[1][2] > x0
+        and tile[1][1] < y1 and tile[1][3] > y0
+    ]
+
+
+def clear_metadata_cache() -> None:
+    """
+    Forget the metadata files loaded so far by this process, so that the
+    next request for each of them checks S3 for a newer version again.
+    """
+    with _metadata_cache_lock:
+        _metadata_cache.clear()
+
+
+class _S3RangeReader(io.RawIOBase):
+    """
+    A read-only, seekable file object backed by byte-range GETs of a
+    file in S3, so that a TIFF can be opened and partially decoded
+    without downloading all of it.
+
+    Opening the reader downloads the first _RANGE_READ_SIZE bytes of the
+    file (which also gives its size and ETag, so no HEAD request is
+    needed); these are kept so that download_to can reuse them if the
+    whole file turns out to be needed after all.
+
+    Reads are answered from two buffers: the span most recently passed
+    to prefetch (reads are cut short at its end), and a block of at
+    least _RANGE_READ_SIZE bytes that is re-fetched whenever a read
+    falls outside both, so that the many
+    small reads made while parsing a TIFF header are answered from
+    memory. All requests after the first are made with the ETag of the
+    file at the time it was opened, so that they fail rather than
+    mixing bytes from two versions of the file.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, aws_key: str):
+        super().__init__()
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self._aws_key = aws_key
+        try:
+            response = s3_client.get_object(
+                Bucket=bucket_name,
+                Key=aws_key,
+                Range='bytes=0-%d' % (_RANGE_READ_SIZE - 1)
+            )
+        except ClientError as err:
+            if err.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            msg = '\nquerying bucket for %s ' % aws_key
+            msg += 'returned 0 results\n'
+            raise RuntimeError(msg) from err
+        self._etag = response['ETag'].strip('"')
+        # ContentRange is 'bytes <first>-<last>/<size>'
+        self._size = int(response['ContentRange'].rsplit('/', 1)[1])
+        self._pos = 0
+        self._head = (0, response['Body'].read())
+        self._block = self._head
+        self._span = (0, b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self._pos = offset
+        return self._pos
+
+    def _get_range(self, start: int, end: int) -> Tuple[int, bytes]:
+        """
+        Download and return (start, bytes [start, end) of the file)
+        """
+        end = min(end, self._size)
+        if start >= end:
+            return (start, b'')
+        response = self._s3_client.get_object(
+            Bucket=self._bucket_name,
+            Key=self._aws_key,
+            Range='bytes=%d-%d' % (start, end - 1),
+            IfMatch='"%s"' % self._etag
         )
+        return (start, response['Body'].read())
 
-        if not _compare_md5(local_filename, target_md5):
-            msg = '\nDownloaded section_data_sets.json; '
-            msg += 'md5 checksum != %s\n' % target_md5
-            raise RuntimeError(msg)
+    def download_to(self, fileobj, transfer_config: TransferConfig):
+        """
+        Write the whole file to fileobj, reusing the bytes downloaded
+        when the reader was opened. The rest of the file is downloaded
+        in parts of transfer_config.multipart_chunksize bytes, up to
+        transfer_config.max_concurrency of them at once.
+        """
+        fileobj.write(self._head[1])
+        chunk_size = transfer_config.multipart_chunksize
+        ranges = [
+            (start, start + chunk_size)
+            for start in range(len(self._head[1]), self._size, chunk_size)
+        ]
+        max_workers = (
+            transfer_config.max_concurrency
+            if transfer_config.use_threads else 1
+        )
+        if len(ranges) <= 1 or max_workers <= 1:
+            for (start, end) in ranges:
+                fileobj.write(self._get_range(start, end)[1])
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for (_, data) in executor.map(lambda r: self._get_range(*r),
+                                          ranges):
+                fileobj.write(data)
+
+    def prefetch(self, start: int, end: int):
+        """
+        Download bytes [start, end) of the file with a single request
+        and keep them for subsequent reads
+        """
+        self._span = self._get_range(start, end)
+
+    def readinto(self, buf) -> int:
+        n_bytes = min(len(buf), self._size - self._pos)
+        if n_bytes <= 0:
+            return 0
+        (block_start, block) = self._span
+        offset = self._pos - block_start
+        if 0 <= offset < len(block):
+            # a short read at the end of the prefetched span is fine for
+            # image data (PIL reads it in arbitrary chunks)
+            n_bytes = min(n_bytes, len(block) - offset)
+        else:
+            (block_start, block) = self._block
+            offset = self._pos - block_start
+        if not (0 <= offset and offset + n_bytes <= len(block)):
+            self._block = self._get_range(
+                self._pos, self._pos + max(n_bytes, _RANGE_READ_SIZE)
+            )
+            (offset, block) = (0, self._block[1])
+        buf[:n_bytes] = block[offset:offset + n_bytes]
+        self._pos += n_bytes
+        return n_bytes
+
+
+def _fetch_raw_tiles(
+    img: Image.Image, reader: _S3RangeReader,
+    box: Tuple[int, int, int, int]
+) -> bool:
+    """
+    If img (opened from reader, but not yet loaded) is an uncompressed
+    TIFF, restrict it to the rows of the strips/tiles that overlap
+    box = (x0, y0, x1, y1) and download the span of the file containing
+    them with a single request.
+
+    Returns False, without modifying img, if img is compressed and so
+    must be read in its entirety.
+    """
+    if any(tile[0] != 'raw' for tile in img.tile):
+        return False
 
-    return None
+    _restrict_tiles(img, box)
+
+    bits_per_sample = img.tag_v2.get(258, 1)
+    if isinstance(bits_per_sample, tuple):
+        bits_per_sample = sum(bits_per_sample)
+    if img.tag_v2.get(284, 1) != 1:
+        # samples are stored in separate planes; leave the tiles as
+        # they are and read them on demand
+        return True
+
+    (y0, y1) = (box[1], box[3])
+    tiles = []
+    spans = []
+    for tile in img.tile:
+        (decoder_name, extents, offset, args) = tile
+        (tile_x0, tile_y0, tile_x1, tile_y1) = extents
+        stride = args[1]
+        if not stride:
+            if ((tile_x1 - tile_x0) * bits_per_sample) % 8:
+                return True
+            stride = (tile_x1 - tile_x0) * bits_per_sample // 8
+        if args[2] != 1:
+            # rows are stored bottom-to-top
+            return True
+
+        # rows are stored top-to-bottom, one every stride bytes
+        row_0 = max(tile_y0, y0)
+        row_1 = min(tile_y1, y1)
+        offset += (row_0 - tile_y0) * stride
+        extents = (tile_x0, row_0, tile_x1, row_1)
+        if hasattr(tile, '_replace'):
+            # Pillow >= 11 stores tiles as ImageFile._Tile named tuples
+            # (and reads their fields by name when loading)
+            tile = tile._replace(extents=extents, offset=offset)
+        else:
+            tile = (decoder_name, extents, offset, args)
+        tiles.append(tile)
+        spans.append((offset, offset + (row_1 - row_0) * stride))
+
+    if tiles:
+        img.tile = tiles
+        reader.prefetch(min(span[0] for span in spans),
+                        max(span[1] for span in spans))
+    return True
 
 
 def download_s3_metadata_file(
@@ -132,7 +618,8 @@ def download_s3_metadata_file(
     downloaded_local_fname: str,
     metadata_s3_key: str,
     s3_client = None,
-    bucket_name: str = "allen-mouse-brain-atlas"
+    bucket_name: str = "allen-mouse-brain-atlas",
+    max_age: Optional[float] = None
 ) -> Union[dict, List[dict]]:
     """Download and parse a metadata *.json file for the Allen Mouse Brain
     Atlas dataset.
@@ -153,12 +640,27 @@ def download_s3_metadata_file(
     bucket_name : str, optional
         The name of the bucket to download the metadata file from,
         by default "allen-mouse-brain-atlas"
+    max_age : Optional[float], optional
+        If a previously downloaded copy of the file was checked against
+        S3 less than max_age seconds ago, use it without contacting S3.
+        By default None, which means the local copy is always checked.
 
     Returns
     -------
     Union[dict, List[dict]]
         The parsed contents of a *.json file. Can be a list of dicts or
         just a dict.
+
+    Notes
+    -----
+    The contents of the files loaded most recently are also held in
+    memory, keyed on their ETag. If max_age is None, a local copy whose
+    version is held in memory is not checked against S3 again by this
+    process; otherwise the copy in memory is only used while the local
+    copy was checked less than max_age seconds ago (so never if max_age
+    is 0). Each call returns a newly parsed object, so callers may modify
+    it freely. Use clear_metadata_cache() to force the files to be
+    checked again.
     """
     if type(download_directory) is str:
         download_directory = Path(download_directory).resolve()
@@ -171,23 +673,56 @@ def download_s3_metadata_file(
 
     local_metadata_path = download_directory / downloaded_local_fname
 
-    _get_aws_file(
-        aws_key=metadata_s3_key,
-        local_filename=local_metadata_path,
-        s3_client=s3_client,
-        bucket_name=bucket_name
-    )
+    # the local copy's sidecar says which version of the file it is, and
+    # when it was last checked against S3
+    data = None
+    sidecar = _read_sidecar(local_metadata_path)
+    if sidecar is not None and (
+        max_age is None or time.time() - sidecar.get('checked', 0) < max_age
+    ):
+        cache_key = (bucket_name, metadata_s3_key, sidecar['etag'])
+        with _metadata_cache_lock:
+            # re-insert on a hit so that the least recently used entries
+            # are the first to be evicted
+            data = _metadata_cache.pop(cache_key, None)
+            if data is not None:
+                _metadata_cache[cache_key] = data
+
+    if data is None:
+        # if the file has to be downloaded, keep the verified bytes as
+        # they came off the network rather than reading the file back
+        chunks = []
+        _get_aws_file(
+            aws_key=metadata_s3_key,
+            local_filename=local_metadata_path,
+            s3_client=s3_client,
+            bucket_name=bucket_name,
+            max_age=max_age,
+            chunks=chunks
+        )
 
-    with local_metadata_path.open('rb') as f:
-        metadata = json.load(f)
+        if chunks:
+            data = b''.join(chunks)
+        else:
+            with local_metadata_path.open('rb') as f:
+                data = f.read()
 
-    return metadata
+        sidecar = _read_sidecar(local_metadata_path)
+        if sidecar is not None:
+            cache_key = (bucket_name, metadata_s3_key, sidecar['etag'])
+            with _metadata_cache_lock:
+                _metadata_cache[cache_key] = data
+                while len(_metadata_cache) > _METADATA_CACHE_SIZE:
+                    del _metadata_cache[next(iter(_metadata_cache))]
+
+    return orjson.loads(data)
 
 
 def get_atlas_metadata(
     download_directory: Union[str, Path],
     s3_client=None,
-    bucket_name: str = 'allen-mouse-brain-atlas'
+    bucket_name: str = 'allen-mouse-brain-atlas',
+    max_age: Optional[float] = None
 ) -> List[dict]:
     """
     Load the metadata for the entire atlas into memory.
@@ -206,6 +741,10 @@ def get_atlas_metadata(
         directories will be created automatically.
     bucket_name : str
         The name of the S3 bucket to download metadata from.
+    max_age : Optional[float]
+        If the metadata was already downloaded and checked against S3
+        less than max_age seconds ago, load the local copy without
+        contacting S3 at all. By default None (always check).
 
     Returns
     -------
@@ -217,17 +756,93 @@ def get_atlas_metadata(
         download_directory=download_directory,
         metadata_s3_key="section_data_sets.json",
         downloaded_local_fname="section_data_sets.json",
-        bucket_name=bucket_name
+        s3_client=s3_client,
+        bucket_name=bucket_name,
+        max_age=max_age
     )
 
     return metadata
 
 
+def get_atlas_metadata_for_section(
+    section_id: int,
+    download_directory: Union[str, Path],
+    s3_client=None,
+    bucket_name: str = 'allen-mouse-brain-atlas'
+) -> dict:
+    """
+    Get the atlas-level metadata (i.e. the entry in
+    section_data_sets.json) for a single image series.
+
+    Rather than downloading the entire atlas metadata file, S3 Select is
+    used to filter section_data_sets.json on the server so that only the
+    matching record is transferred. If the bucket does not support S3
+    Select, this falls back to get_atlas_metadata (which downloads
+    section_data_sets.json to `download_directory`).
+
+    Parameters
+    ----------
+    section_id : int
+        An integer representing the section whose metadata should be loaded
+    download_directory : Union[str, Path]
+        The local directory to which section_data_sets.json is downloaded
+        if S3 Select is not available.
+    s3_client
+        A boto3.Client of the S3 variety. If None, this function will
+        try to create an s3 client with anonymous credentials which is
+        sufficient to access public AWS services
+    bucket_name : str
+        The name of the S3 bucket to download metadata from.
+
+    Returns
+    -------
+    A dict containing the atlas metadata for the specified section_id.
+    """
+    section_id = int(section_id)
+
+    if s3_client is None:
+        s3_client = get_public_boto3_client()
+
+    try:
+        response = s3_client.select_object_content(
+            Bucket=bucket_name,
+            Key='section_data_sets.json',
+            ExpressionType='SQL',
+            Expression=(
+                'SELECT * FROM S3Object[*] s WHERE s.id = %d' % section_id
+            ),
+            InputSerialization={'JSON': {'Type': 'DOCUMENT'}},
+            OutputSerialization={'JSON': {}}
+        )
+        payload = b''.join(
+            event['Records']['Payload']
+            for event in response['Payload'] if 'Records' in event
+        )
+        records = [orjson.loads(line) for line in payload.splitlines()
+                   if line.strip()]
+    except ClientError:
+        records = [
+            obj for obj in get_atlas_metadata(
+                download_directory=download_directory,
+                s3_client=s3_client,
+                bucket_name=bucket_name
+            ) if obj['id'] == section_id
+        ]
+
+    if len(records) != 1:
+        msg = '\nsection_data_sets.json has %d ' % len(records)
+        msg += 'entries for section_id %d\n' % section_id
+        raise RuntimeError(msg)
+
+    return records[0]
+
+
 def get_section_metadata(
         section_id: int,
         download_directory: Union[str, Path],
         s3_client=None,
-        bucket_name: str = 'allen-mouse-brain-atlas'
+        bucket_name: str = 'allen-mouse-brain-atlas',
+        max_age: Optional[float] = None
     ) -> dict:
     """
     Get the dict representing the metadata for a specific image series.
@@ -246,6 +861,10 @@ def get_section_metadata(
         directories will be created automatically.
     bucket_name : str
         The name of the S3 bucket to download metadata from.
+    max_age : Optional[float]
+        If the metadata was already downloaded and checked against S3
+        less than max_age seconds ago, load the local copy without
+        contacting S3 at all. By default None (always check).
 
     Returns
     -------
@@ -259,23 +878,99 @@ def get_section_metadata(
         download_directory=download_directory,
         metadata_s3_key=metadata_s3_key,
         downloaded_local_fname=local_fname,
-        bucket_name=bucket_name
+        s3_client=s3_client,
+        bucket_name=bucket_name,
+        max_age=max_age
     )
 
     return metadata
 
 
+def get_section_metadata_batch(
+        section_ids: Iterable[int],
+        download_directory: Union[str, Path],
+        s3_client=None,
+        bucket_name: str = 'allen-mouse-brain-atlas',
+        max_workers: int = 16
+    ) -> List[dict]:
+    """
+    Get the metadata for many image series at once. The metadata files
+    are downloaded in parallel threads that all share a single s3_client,
+    so the S3 round trips for different sections overlap instead of
+    running one after another.
+
+    Parameters
+    ----------
+    section_ids : Iterable[int]
+        The sections whose metadata should be loaded
+    download_directory : Union[str, Path]
+        The desired local directory path to save downloaded metadata. If the
+        provided directory does not exist, it and any necessary parent
+        directories will be created automatically.
+    s3_client
+        A boto3.Client of the S3 variety. If None, this function will
+        try to create an s3 client with anonymous credentials which is
+        sufficient to access public AWS services
+    bucket_name : str
+        The name of the S3 bucket to download metadata from.
+    max_workers : int
+        The maximum number of sections to download at the same time,
+        by default 16
+
+    Returns
+    -------
+    A list of dicts containing the metadata for each of the specified
+    section_ids (in the same order as section_ids).
+    """
+    if type(download_directory) is str:
+        download_directory = Path(download_directory).resolve()
+
+    if not download_directory.exists():
+        download_directory.mkdir(parents=True, exist_ok=True)
+
+    if s3_client is None:
+        s3_client = get_public_boto3_client()
+
+    def _get_one(section_id: int) -> dict:
+        return get_section_metadata(
+            section_id=section_id,
+            download_directory=download_directory,
+            s3_client=s3_client,
+            bucket_name=bucket_name
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        metadata = list(executor.map(_get_one, section_ids))
+
+    return metadata
+
+
+class _SectionIndex(NamedTuple):
+    """
+    The metadata of a section_data_set along with lookup tables for
+    its section images
+    """
+    metadata: dict
+    tissue_index_to_section_img: Dict[int, dict]
+    subimg_to_tissue_index: Dict[int, int]
+    tissue_index_to_subimg: Dict[int, int]
+    tissue_indices: Tuple[int, ...]
+    sub_image_ids: Tuple[int, ...]
+
+
 class SectionDataSet(object):
 
     def __init__(
         self,
         section_id: int,
         download_directory: Union[str, Path],
-        s3_client=None
+        s3_client=None,
+        transfer_config=None
     ):
         """
-        Load and store the metadata for the section_data_set specified
-        by section_id. Use the boto3 s3_client provided as a kwarg.
+        Provide access to the metadata and images for the section_data_set
+        specified by section_id. Use the boto3 s3_client provided as a
+        kwarg. The metadata is downloaded the first time it is needed.
 
         Parameters
         ----------
@@ -288,6 +983,10 @@ class SectionDataSet(object):
         s3_client :
             A boto3.Client of the S3 variety. If None, an s3 client with
             anonymous credentials will be automatically created.
+        transfer_config :
+            A boto3.s3.transfer.TransferConfig controlling how images are
+            downloaded. If None, the result of
+            aws_utils.get_transfer_config() is used.
         """
 
         if type(download_directory) is str:
@@ -299,35 +998,83 @@ class SectionDataSet(object):
         if s3_client is None:
             s3_client = get_public_boto3_client()
 
+        if transfer_config is None:
+            transfer_config = get_transfer_config()
+
         self.download_dir = download_directory
         self.section_id = section_id
         self.s3_client = s3_client
-        self.metadata = get_section_metadata(
-            section_id=section_id,
-            download_directory=download_directory
+        self.transfer_config = transfer_config
+
+    @functools.cached_property
+    def _index(self) -> _SectionIndex:
+        """
+        Download (if necessary) and index the metadata for this
+        section_data_set. This is deferred until the metadata is first
+        needed so that constructing a SectionDataSet is cheap.
+        """
+        metadata = get_section_metadata(
+            section_id=self.section_id,
+            download_directory=self.download_dir,
+            s3_client=self.s3_client
         )
 
         # remove section images and construct dicts keyed on
-        # tissue_index and sub_image_id
-        tmp_section_images = self.metadata.pop('section_images')
-
-        self.tissue_index_to_section_img = {}
-        self.subimg_to_tissue_index = {}
-        self.tissue_index_to_subimg = {}
-        for img in tmp_section_images:
-            tissue_index = img['section_number']
-            assert tissue_index not in self.tissue_index_to_section_img
-            self.tissue_index_to_section_img[tissue_index] = img
-            subimg_id = img['id']
-            assert subimg_id not in self.subimg_to_tissue_index
-            self.subimg_to_tissue_index[subimg_id] = tissue_index
-            assert tissue_index not in self.tissue_index_to_subimg
-            self.tissue_index_to_subimg[tissue_index] = subimg_id
-
-        self._tissue_indices = list(self.tissue_index_to_section_img.keys())
-        self._tissue_indices.sort()
-        self._subimg_ids = list(self.subimg_to_tissue_index.keys())
-        self._subimg_ids.sort()
+        # tissue_index and sub_image_id; sorting the images by
+        # tissue_index once up front means the dicts (and the list
+        # of tissue indices) come out already in sorted order
+        rows = sorted(
+            ((img['section_number'], img['id'], img)
+             for img in metadata.pop('section_images')),
+            key=operator.itemgetter(0)
+        )
+
+        tissue_index_to_section_img = {
+            tissue_index: img for tissue_index, _, img in rows
+        }
+        tissue_index_to_subimg = {
+            tissue_index: subimg_id for tissue_index, subimg_id, _ in rows
+        }
+        subimg_to_tissue_index = {
+            subimg_id: tissue_index for tissue_index, subimg_id, _ in rows
+        }
+
+        # each tissue_index and sub_image_id must be unique
+        if (len(tissue_index_to_section_img) != len(rows)
+                or len(subimg_to_tissue_index) != len(rows)):
+            raise ValueError(
+                '\nduplicate tissue_index or sub_image id in the '
+                'metadata for section_data_set_%d\n' % self.section_id
+            )
+
+        return _SectionIndex(
+            metadata=metadata,
+            tissue_index_to_section_img=tissue_index_to_section_img,
+            subimg_to_tissue_index=subimg_to_tissue_index,
+            tissue_index_to_subimg=tissue_index_to_subimg,
+            tissue_indices=tuple(tissue_index_to_section_img),
+            sub_image_ids=tuple(sorted(subimg_to_tissue_index))
+        )
+
+    @property
+    def metadata(self) -> dict:
+        """
+        The metadata for the section_data_set (without the
+        'section_images' list, which is indexed separately)
+        """
+        return self._index.metadata
+
+    @property
+    def tissue_index_to_section_img(self) -> Dict[int, dict]:
+        return self._index.tissue_index_to_section_img
+
+    @property
+    def subimg_to_tissue_index(self) -> Dict[int, int]:
+        return self._index.subimg_to_tissue_index
+
+    @property
+    def tissue_index_to_subimg(self) -> Dict[int, int]:
+        return self._index.tissue_index_to_subimg
 
     @property
     def tissue_indices(self):
@@ -335,7 +1082,7 @@ class SectionDataSet(object):
         Return a sorted list of all of the tissue index values
         available for the section_data_set
         """
-        return self._tissue_indices
+        return list(self._index.tissue_indices)
 
     @property
     def sub_image_ids(self):
@@ -343,39 +1090,63 @@ class SectionDataSet(object):
         Return a sorted list of all the sub-image ID values
         for the section_data_set
         """
-        return self._subimg_ids
+        return list(self._index.sub_image_ids)
 
-    def image_metadata_from_tissue_index(self, tissue_index):
+    def image_metadata_from_tissue_index(
+        self, tissue_index: int, warn: bool = True
+    ):
         """
         Return the metadata of the section_image associated with the
         specified tissue_index.
 
-        Returns None if an invalid tissue_index is specified
+        Returns None if an invalid tissue_index is specified (and, if
+        warn is True, emits a warning). Pass warn=False when scanning
+        many candidate tissue_indexes that are expected to be missing.
         """
         if tissue_index not in self.tissue_index_to_section_img:
-            warnings.warn("tissue_index %d does not "
-                          "exist in section_data_set_%d" %
-                          (tissue_index, self.section_id))
+            if warn:
+                warnings.warn("tissue_index %d does not "
+                              "exist in section_data_set_%d" %
+                              (tissue_index, self.section_id))
             return None
 
-        return copy.deepcopy(self.tissue_index_to_section_img[tissue_index])
+        # the metadata was parsed from JSON, so serializing and parsing
+        # it again gives a deep copy several times faster than deepcopy
+        return orjson.loads(
+            orjson.dumps(self._image_metadata_view(tissue_index))
+        )
+
+    def _image_metadata_view(self, tissue_index: int) -> dict:
+        """
+        Return the internal (not copied) metadata dict of the
+        section_image associated with the specified tissue_index.
+
+        This is for read-only use inside this class; it avoids the
+        copy made by the public image_metadata_from_* methods.
+        Raises a KeyError if tissue_index is invalid.
+        """
+        return self.tissue_index_to_section_img[tissue_index]
 
-    def image_metadata_from_sub_image(self, sub_image):
+    def image_metadata_from_sub_image(
+        self, sub_image: int, warn: bool = True
+    ):
         """
         Return the metadata of the section_image associated with the
         specified subimage ID
 
-        Returns None if an invalid subimage ID is specified
+        Returns None if an invalid subimage ID is specified (and, if
+        warn is True, emits a warning)
         """
         if sub_image not in self.subimg_to_tissue_index:
-            warnings.warn("sub_image %d does not exist "
-                          "in section_data_set_%d" %
-                          (sub_image, self.section_id))
+            if warn:
+                warnings.warn("sub_image %d does not exist "
+                              "in section_data_set_%d" %
+                              (sub_image, self.section_id))
 
             return None
 
         tissue_index = self.subimg_to_tissue_index[sub_image]
-        return self.image_metadata_from_tissue_index(tissue_index)
+        return self.image_metadata_from_tissue_index(tissue_index, warn=warn)
 
     def _download_img(
         self, tissue_index: int, downsample: int,
@@ -413,11 +1184,12 @@ class SectionDataSet(object):
                               "clobber=True to overwrite" % local_savepath)
                 return False
 
-        img_metadata = self.image_metadata_from_tissue_index(tissue_index)
+        img_metadata = self._image_metadata_view(tissue_index)
         fname = img_metadata['image_file_name']
 
         downsample_key = 'downsample_%d' % downsample
-        if downsample_key not in img_metadata['downsampling'].keys():
+        tier_metadata = img_metadata['downsampling'].get(downsample_key)
+        if tier_metadata is None:
             warnings.warn("%d is not a valid downsampling tier for %s"
                           % (downsample, fname))
             return False
@@ -425,39 +1197,50 @@ class SectionDataSet(object):
             self.section_id, downsample_key, fname
         )
 
-        # Download the TIFF into a temporary location
-        # then use PIL to crop the image to only include
-        # the specified section of brain.
-
-        with tempfile.NamedTemporaryFile(
-            mode="wb",
-            dir=self.download_dir,
-            prefix="tmp_before_crop_",
-            suffix=".tiff"
-        ) as f:
-
-            self.s3_client.download_fileobj(
-                Bucket='allen-mouse-brain-atlas',
-                Key=aws_key,
-                Fileobj=f
-            )
-
-            tier_metadata = img_metadata['downsampling'][downsample_key]
-            x0 = tier_metadata['x']
-            y0 = tier_metadata['y']
-            x1 = x0 + tier_metadata['width']
-            y1 = y0 + tier_metadata['height']
-
-            with Image.open(Path(f.name).resolve(), "r") as img:
-                cropped_img = img.crop((x0, y0, x1, y1))
-                cropped_img.save(str(local_savepath))
-                cropped_img.close()
+        x0 = tier_metadata['x']
+        y0 = tier_metadata['y']
+        x1 = x0 + tier_metadata['width']
+        y1 = y0 + tier_metadata['height']
+
+        # If the TIFF is uncompressed, only download the header and
+        # the rows of pixels that contain the specified section of brain.
+        with _S3RangeReader(
+            self.s3_client, 'allen-mouse-brain-atlas', aws_key
+        ) as reader:
+            with Image.open(reader, "r") as img:
+                if _fetch_raw_tiles(img, reader, (x0, y0, x1, y1)):
+                    cropped_img = img.crop((x0, y0, x1, y1))
+                    cropped_img.save(str(local_savepath))
+                    cropped_img.close()
+                    return True
+
+            # Otherwise, download the rest of the TIFF into memory (only
+            # spilling over to a temporary file in download_dir if it is
+            # very large) then use PIL to crop the image to only include
+            # the specified section of brain.
+
+            with tempfile.SpooledTemporaryFile(
+                max_size=_MAX_IN_MEMORY_IMAGE_SIZE,
+                mode="w+b",
+                dir=self.download_dir,
+                prefix="tmp_before_crop_",
+                suffix=".tiff"
+            ) as f:
+
+                reader.download_to(f, self.transfer_config)
+                f.seek(0)
+
+                with Image.open(f, "r") as img:
+                    _restrict_tiles(img, (x0, y0, x1, y1))
+                    cropped_img = img.crop((x0, y0, x1, y1))
+                    cropped_img.save(str(local_savepath))
+                    cropped_img.close()
 
         return True
 
     def download_image_from_tissue_index(
         self, tissue_index: int, downsample: int,
-        local_savepath: Path, clobber: bool = False
+        local_savepath: Path, clobber: bool = False, warn: bool = True
     ):
         """
         Download a TIFF file specified by its tissue_index and downsampling
@@ -478,15 +1261,19 @@ class SectionDataSet(object):
         local_savepath. If False, raise a warning and exit in
         the case where local_savepath already exists
 
+        warn is a boolean. If False, do not emit a warning when
+        tissue_index does not exist in this section_data_set
+
         Returns
         -------
         True if the TIFF was successfully downloaded to local_savepath;
         False if not
         """
         if tissue_index not in self.tissue_index_to_section_img:
-            warnings.warn("tissue_index %d does not exist in "
-                          "section_data_set_%d" %
-                          (tissue_index, self.section_id))
+            if warn:
+                warnings.warn("tissue_index %d does not exist in "
+                              "section_data_set_%d" %
+                              (tissue_index, self.section_id))
             return False
         return self._download_img(
             tissue_index, downsample, local_savepath, clobber=clobber
@@ -494,7 +1281,7 @@ class SectionDataSet(object):
 
     def download_image_from_sub_image(
         self, sub_image: int, downsample: int,
-        local_savepath: str, clobber: bool = False
+        local_savepath: str, clobber: bool = False, warn: bool = True
     ):
         """
         Download a TIFF file specified by its sub-image ID and downsampling
@@ -515,21 +1302,93 @@ class SectionDataSet(object):
         local_savepath. If False, raise a warning and exit in the
         case where local_savepath already exists
 
+        warn is a boolean. If False, do not emit a warning when
+        sub_image does not exist in this section_data_set
+
         Returns
         -------
         True if the TIFF was successfully downloaded to local_savepath;
         False if not
         """
         if sub_image not in self.subimg_to_tissue_index:
-            warnings.warn("sub_image %d does not exist "
-                          "in section_data_set_%d" %
-                          (sub_image, self.section_id))
+            if warn:
+                warnings.warn("sub_image %d does not exist "
+                              "in section_data_set_%d" %
+                              (sub_image, self.section_id))
             return False
         tissue_index = self.subimg_to_tissue_index[sub_image]
         return self.download_image_from_tissue_index(
             tissue_index, downsample, local_savepath, clobber=clobber
         )
 
+    def download_images_bulk(
+        self, tissue_indices: Iterable[int], downsample: int,
+        local_directory: Union[str, Path], clobber: bool = False,
+        max_workers: int = 16
+    ) -> Dict[int, Union[bool, Exception]]:
+        """
+        Download many TIFF files, specified by their tissue_indexes and a
+        downsampling tier, in parallel threads that share this
+        SectionDataSet's s3_client.
+
+        Parameters
+        ----------
+        tissue_indices is an iterable of the integer tissue_indexes
+        of the TIFFs to be downloaded
+
+        downsample is an integer denoting the downsampling
+        tier of the TIFFs to be downloaded
+
+        local_directory is the directory where the TIFF files should be
+        saved. Each is saved as
+        section_data_set_{section_id}_tissue_{tissue_index}_downsample_{downsample}.tiff
+        (the directory is created if it does not exist)
+
+        clobber is a boolean. If True, overwrite pre-existing files.
+        If False, raise a warning and skip any file that already exists
+
+        max_workers is the maximum number of TIFFs to download at the
+        same time (Default: 16)
+
+        Returns
+        -------
+        A dict mapping each tissue_index to the result of
+        download_image_from_tissue_index for that image (True or False)
+        or, if downloading it raised an exception, to that exception
+        """
+        if type(local_directory) is str:
+            local_directory = Path(local_directory).resolve()
+
+        if not local_directory.exists():
+            local_directory.mkdir(parents=True, exist_ok=True)
+
+        # load the metadata before starting the threads so that they
+        # do not all try to download it at once
+        self._index
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                tissue_index: executor.submit(
+                    self.download_image_from_tissue_index,
+                    tissue_index,
+                    downsample,
+                    local_directory / (
+                        'section_data_set_%d_tissue_%d_downsample_%d.tiff'
+                        % (self.section_id, tissue_index, downsample)
+                    ),
+                    clobber=clobber
+                )
+                # each image is only downloaded once, however often its
+                # tissue_index is listed
+                for tissue_index in dict.fromkeys(tissue_indices)
+            }
+
+        results = dict()
+        for tissue_index, future in futures.items():
+            err = future.exception()
+            results[tissue_index] = future.result() if err is None else err
+        return results
+
     def section_url(self):
         """
         Return the URL for the brain-map.org viewer for this SectionDataSet
@@ -1,18 +1,97 @@
+import threading
+from typing import Optional
+
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore import UNSIGNED
 from botocore.client import Config
 
 
-def get_public_boto3_client():
+_public_client = None
+_public_client_lock = threading.Lock()
+
+
+def _public_client_config() -> Config:
+    """Return the botocore Config used by get_public_boto3_client."""
+    return Config(
+        signature_version=UNSIGNED,
+        s3={'addressing_style': 'virtual'},
+        max_pool_connections=64,
+        retries={'max_attempts': 4, 'mode': 'standard'},
+        tcp_keepalive=True
+    )
+
+
+def get_public_boto3_client(config: Optional[Config] = None):
     """Convenience function to return a boto3 client that can access
     publically available AWS services (like public S3 buckets) without
     any AWS credentials.
 
+    Without a `config`, the client is only constructed on the first call;
+    later calls return the same instance so that the (relatively
+    expensive) client setup and its pool of open connections are shared.
+    It is safe to call this function, and to use the client, from several
+    threads at once. The connection pool is sized for many threads
+    downloading at once, and throttled or failed requests are retried
+    (up to 4 times, with exponential back-off) before giving up.
+
+    Parameters
+    ----------
+    config : Optional[Config]
+        A botocore.client.Config whose settings (e.g. retries or
+        timeouts) override the defaults described above. If given, a new
+        client is returned rather than the shared one. Requests are
+        always unsigned.
+
     Returns
     -------
     A boto3 client instance.
     """
-    public_client = boto3.client(
-        's3', config=Config(signature_version=UNSIGNED)
+    if config is not None:
+        default_config = _public_client_config()
+        # merge replaces the whole retries dict; keep the default mode
+        # if only the number of attempts is given (and vice versa)
+        retries = dict(default_config.retries, **(config.retries or {}))
+        config = default_config.merge(config).merge(
+            Config(signature_version=UNSIGNED, retries=retries)
+        )
+        return boto3.session.Session().client('s3', config=config)
+
+    global _public_client
+    with _public_client_lock:
+        if _public_client is None:
+            # use a private session; the default session that
+            # boto3.client uses is not safe to share between threads
+            _public_client = boto3.session.Session().client(
+                's3', config=_public_client_config()
+            )
+    return _public_client
+
+
+def get_transfer_config(max_concurrency: int = 10) -> TransferConfig:
+    """Return a boto3 TransferConfig tuned for downloading large files
+    (e.g. image TIFFs) from S3. Files larger than 8 MB are fetched as
+    several byte-range requests in parallel.
+
+    Parameters
+    ----------
+    max_concurrency : int
+        The maximum number of threads used to download parts of a single
+        file in parallel, by default 10. On slow or congested networks
+        many parallel requests can be slower than a few; lower this value
+        (down to 1, which disables threading) if downloads stall or time
+        out.
+
+    Returns
+    -------
+    TransferConfig
+        A boto3.s3.transfer.TransferConfig instance that can be passed as
+        the `Config` argument of `download_file`/`download_fileobj`.
+    """
+    return TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=max_concurrency,
+        use_threads=max_concurrency > 1,
+        io_chunksize=1024 * 1024
     )
-    return public_client
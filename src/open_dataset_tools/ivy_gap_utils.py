@@ -1,14 +1,58 @@
+import contextlib
 import io
+import itertools
+import os
+import threading
+import uuid
 import warnings
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import matplotlib.image as mp_img
 from PIL import Image
 
-from open_dataset_tools.aws_utils import get_public_boto3_client
+from open_dataset_tools.aws_utils import (
+    get_public_boto3_client,
+    get_transfer_config
+)
+
+
+_BUCKET_NAME = "allen-ivy-glioblastoma-atlas"
+_BUCKET_PREFIX = f"s3://{_BUCKET_NAME}/"
+
+# IVY GAP images are large, so fetch them with parallel ranged GETs
+_TRANSFER_CONFIG = get_transfer_config()
+
+# IVY GAP slide images are far larger than Pillow's default decompression
+# bomb limit, so the limit is lifted while they are opened and cropped;
+# see _lift_pixel_limit
+_pixel_limit_lock = threading.Lock()
+_pixel_limit_users = 0
+_saved_pixel_limit = None
+
+# number of bytes initially fetched by ImagePromise.head(); image headers
+# are almost always well within this
+_HEADER_RANGE_SIZE = 1 << 16
+
+# number of records parsed at a time when reading cached metadata
+_JSON_LINES_CHUNKSIZE = 4096
+
+# the raw JSON of the metadata files downloaded so far by this process,
+# keyed on their S3 key; see _get_cached_metadata
+_METADATA_CACHE_SIZE = 8
+_metadata_cache: Dict[str, bytes] = {}
+_metadata_cache_lock = threading.Lock()
+
+
+def _s3_url_to_key(s3_obj_url: str) -> str:
+    """Return the key, relative to the IVY GAP bucket, of an
+    s3://allen-ivy-glioblastoma-atlas/... URL (other strings are returned
+    unchanged)."""
+    if s3_obj_url.startswith(_BUCKET_PREFIX):
+        return s3_obj_url[len(_BUCKET_PREFIX):]
+    return s3_obj_url
 
 
 def load_s3_json_as_dataframe(client, bucket: str, key: str) -> pd.DataFrame:
@@ -30,27 +74,90 @@ def load_s3_json_as_dataframe(client, bucket: str, key: str) -> pd.DataFrame:
     pd.DataFrame
         A pandas DataFrame
     """
+    # the StreamingBody is file-like, so pandas can read it directly
+    # without first copying the whole response into a BytesIO
     obj = client.get_object(Bucket=bucket, Key=key)["Body"]
-    json_data = io.BytesIO(obj.read())
-    return pd.read_json(json_data)
+    return pd.read_json(obj)
+
+
+def _download_s3_bytes(client, bucket: str, key: str) -> bytes:
+    """Download the object stored at `key` in `bucket` and return its
+    contents."""
+    return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+
+def _get_cached_metadata(client, key: str) -> pd.DataFrame:
+    """Return the metadata table stored at `key`, downloading it with
+    `client` only if it is not already cached.
+
+    The IVY GAP metadata files never change, so the cache is keyed on
+    `key` alone (whichever client is passed). Only the raw JSON is
+    cached, and a new table is parsed from it on every call, so callers
+    may modify the table they are given freely.
+    """
+    with _metadata_cache_lock:
+        data = _metadata_cache.get(key)
+
+    if data is None:
+        data = _download_s3_bytes(client, _BUCKET_NAME, key)
+        with _metadata_cache_lock:
+            _metadata_cache[key] = data
+            while len(_metadata_cache) > _METADATA_CACHE_SIZE:
+                del _metadata_cache[next(iter(_metadata_cache))]
+
+    return pd.read_json(io.BytesIO(data))
+
+
+def clear_metadata_cache():
+    """Forget the metadata tables cached by get_donor_metadata,
+    get_specimen_metadata and get_section_metadata, so that the next call
+    downloads them from S3 again."""
+    with _metadata_cache_lock:
+        _metadata_cache.clear()
 
 
 def get_donor_metadata(client) -> pd.DataFrame:
-    bucket = "allen-ivy-glioblastoma-atlas"
     key = "donor_metadata.json"
-    return load_s3_json_as_dataframe(client, bucket, key)
+    return _get_cached_metadata(client, key)
 
 
 def get_specimen_metadata(client) -> pd.DataFrame:
-    bucket = "allen-ivy-glioblastoma-atlas"
     key = "specimen_metadata.json"
-    return load_s3_json_as_dataframe(client, bucket, key)
+    return _get_cached_metadata(client, key)
 
 
 def get_section_metadata(client) -> pd.DataFrame:
-    bucket = "allen-ivy-glioblastoma-atlas"
     key = "section_metadata.json"
-    return load_s3_json_as_dataframe(client, bucket, key)
+    return _get_cached_metadata(client, key)
+
+
+@contextlib.contextmanager
+def _lift_pixel_limit():
+    """Turn off Pillow's decompression bomb check (Image.MAX_IMAGE_PIXELS)
+    until the last of any overlapping uses of this context (e.g. from
+    several ImagePromise.load threads) exits, then restore it."""
+    global _pixel_limit_users, _saved_pixel_limit
+    with _pixel_limit_lock:
+        if _pixel_limit_users == 0:
+            _saved_pixel_limit = Image.MAX_IMAGE_PIXELS
+            Image.MAX_IMAGE_PIXELS = None
+        _pixel_limit_users += 1
+    try:
+        yield
+    finally:
+        with _pixel_limit_lock:
+            _pixel_limit_users -= 1
+            if _pixel_limit_users == 0:
+                Image.MAX_IMAGE_PIXELS = _saved_pixel_limit
+
+
+def _image_header(img: Image) -> dict:
+    return {
+        "format": img.format,
+        "mode": img.mode,
+        "width": img.width,
+        "height": img.height
+    }
 
 
 class ImagePromise(object):
@@ -109,9 +216,36 @@ class ImagePromise(object):
     def num_pixels(self) -> int:
         return self._image_width * self._image_height
 
-    def load(self) -> Image:
+    def load(
+        self,
+        roi: Optional[Tuple[int, int, int, int]] = None,
+        downsample: int = 1
+    ) -> Image:
+        """Load the image.
+
+        Parameters
+        ----------
+        roi : Optional[Tuple[int, int, int, int]]
+            A (left, upper, right, lower) box, in full resolution pixel
+            coordinates, to crop the image to. By default the whole image
+            is returned.
+        downsample : int
+            Factor by which to shrink the image (or `roi`) in each
+            dimension, by default 1 (full resolution). For JPEGs the
+            shrinking is (mostly) done while decoding, so the full
+            resolution image is never held in memory.
+
+        Returns
+        -------
+        Image
+            A PIL Image
+        """
+        if downsample < 1:
+            raise ValueError(
+                f"downsample must be a positive integer, got {downsample}"
+            )
 
-        rel_path = self._s3_obj_url.lstrip("s3://allen-ivy-glioblastoma-atlas/")
+        rel_path = _s3_url_to_key(self._s3_obj_url)
 
         if self._local_save_dir is not None:
             file_object = (self._local_save_dir / rel_path).resolve()
@@ -122,24 +256,157 @@ class ImagePromise(object):
             if self._verbose:
                 print(f"Downloading image from: {self._s3_obj_url}")
             img_obj = self._s3_client.download_fileobj(
-                Bucket="allen-ivy-glioblastoma-atlas",
+                Bucket=_BUCKET_NAME,
                 Key=rel_path,
-                Fileobj=file_object
+                Fileobj=file_object,
+                Config=_TRANSFER_CONFIG
             )
 
-        Image.MAX_IMAGE_PIXELS = self.num_pixels
-        with Image.open(file_object, "r") as img:
-            img.load()
+        with _lift_pixel_limit(), Image.open(file_object, "r") as img:
+            if roi is None and downsample == 1:
+                img.load()
+                return img
+
+            full_width, full_height = img.size
+            if roi is None:
+                roi = (0, 0, full_width, full_height)
+            out_size = (
+                max(1, (roi[2] - roi[0]) // downsample),
+                max(1, (roi[3] - roi[1]) // downsample)
+            )
+
+            if downsample > 1:
+                # lets the JPEG decoder scale the image by up to 1/8
+                # while decoding (a no-op for other formats)
+                img.draft(
+                    img.mode,
+                    (full_width // downsample, full_height // downsample)
+                )
+            scale = full_width / img.size[0]
+
+            img = img.crop(tuple(round(c / scale) for c in roi))
+            if img.size != out_size:
+                img = img.resize(out_size, Image.BOX)
 
         return img
 
+    def load_array(
+        self,
+        roi: Optional[Tuple[int, int, int, int]] = None,
+        downsample: int = 1
+    ) -> np.ndarray:
+        """Load the image as a numpy array of shape (height, width) or
+        (height, width, channels). `roi` and `downsample` are as for
+        load()."""
+        return np.asarray(self.load(roi=roi, downsample=downsample))
+
+    def head(self) -> dict:
+        """Read just the header of the image, without loading (or, when
+        the image is on S3, downloading) its pixel data.
+
+        Returns
+        -------
+        dict
+            The image's "format" (e.g. "JPEG"), "mode" (e.g. "RGB"),
+            "width" and "height".
+        """
+        rel_path = _s3_url_to_key(self._s3_obj_url)
+
+        if self._local_save_dir is not None:
+            with _lift_pixel_limit(), Image.open(
+                (self._local_save_dir / rel_path).resolve()
+            ) as img:
+                return _image_header(img)
+
+        # Fetch the start of the file; in the rare case that the header
+        # does not fit, fetch a larger range and try again
+        range_size = _HEADER_RANGE_SIZE
+        while True:
+            data = self._s3_client.get_object(
+                Bucket=_BUCKET_NAME,
+                Key=rel_path,
+                Range=f"bytes=0-{range_size - 1}"
+            )["Body"].read()
+            try:
+                with _lift_pixel_limit(), Image.open(io.BytesIO(data)) as img:
+                    return _image_header(img)
+            except (OSError, SyntaxError):
+                if len(data) < range_size:
+                    # we already had the whole file
+                    raise
+            range_size *= 4
+
+    @classmethod
+    def load_many(
+        cls,
+        promises: Iterable["ImagePromise"],
+        max_workers: int = 16
+    ) -> list:
+        """Load several ImagePromises at once.
+
+        Loading an image is dominated by waiting on S3 (or disk), so the
+        images are loaded from a pool of threads, overlapping the
+        individual requests instead of running them one after another.
+
+        Parameters
+        ----------
+        promises : Iterable[ImagePromise]
+            The ImagePromises to load
+        max_workers : int
+            The maximum number of images to load at the same time,
+            by default 16.
+
+        Returns
+        -------
+        list
+            The loaded PIL Images, in the same order as `promises`.
+        """
+        promises = list(promises)
+        if len(promises) == 0:
+            return []
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda p: p.load(), promises))
+
+
+def _lookup_sub_images(
+    section_meta_table: pd.DataFrame,
+    section_data_set_id: int
+) -> list:
+    """
+    Return the "sub_images" entry of the row of `section_meta_table`
+    whose "section_data_set_id" is `section_data_set_id`.
+
+    If the table is indexed by section_data_set_id this is a hash
+    lookup; otherwise the id column is compared as a numpy array,
+    which avoids building a boolean mask Series and a filtered copy of
+    the table.
+    """
+    if section_meta_table.index.name == "section_data_set_id":
+        if section_data_set_id in section_meta_table.index:
+            return section_meta_table.at[section_data_set_id, "sub_images"]
+    else:
+        matches = np.flatnonzero(
+            section_meta_table["section_data_set_id"].to_numpy()
+            == section_data_set_id
+        )
+        if len(matches) > 0:
+            return section_meta_table["sub_images"].iat[matches[0]]
+
+    e_msg = (
+        f"Could not find the `section_data_set_id` specified "
+        f"({section_data_set_id}) in the `section_meta_table` provided!"
+    )
+    raise RuntimeError(e_msg)
+
 
 def section_image_loader(
     section_meta_table: pd.DataFrame,
     section_data_set_id: int,
     local_save_directory: Optional[Path] = None,
-    verbose: bool = False
-) -> pd.DataFrame:
+    verbose: bool = False,
+    chunksize: Optional[int] = None
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
     """
     Given a section metadata DataFrame and a specific `section_data_set_id`
     return a DataFrame containing image data and metadata associated with
@@ -158,35 +425,81 @@ def section_image_loader(
         is left as None, then images will be downloaded from AWS S3.
     verbose:
         Whether this function should print updates on what it is downloading
-    
+    chunksize: Optional[int]
+        If provided, return an iterator that yields the section image
+        table in DataFrames of (at most) this many rows, instead of
+        building the whole table at once.
+
     Returns
     -------
-    pd.DataFrame
+    Union[pd.DataFrame, Iterator[pd.DataFrame]]
         A section image table that contains metadata about images associated
         with a section as well as "ImagePromise" objects which will
         yield PIL "Image" object instances when ImagePromise.load() is called.
+        If `chunksize` is provided, an iterator over pieces of that table
+        (which yields nothing if the section has no images).
     """
 
-    try:
-        sub_images = section_meta_table[
-            section_meta_table["section_data_set_id"] == section_data_set_id
-        ]["sub_images"].iloc[0]
-
-    except IndexError as e:
-        e_msg = (
-            f"Could not find the `section_data_set_id` specified "
-            f"({section_data_set_id}) in the `section_meta_table` provided!"
-        )
-        raise RuntimeError(e_msg) from e
+    sub_images = _lookup_sub_images(section_meta_table, section_data_set_id)
 
     if local_save_directory is None:
         s3_client = get_public_boto3_client()
+    else:
+        s3_client = None
 
-    loaded_sub_images = []
+    rows = _section_image_rows(
+        sub_images, local_save_directory, s3_client, verbose
+    )
+
+    if chunksize is None:
+        rows = list(rows)
+        if len(rows) == 0:
+            # a section without images still gets the usual columns
+            return pd.DataFrame(
+                columns=_section_image_columns(section_meta_table)
+            )
+        return pd.DataFrame(rows)
+
+    return _chunk_rows(rows, chunksize)
+
+
+def _section_image_columns(section_meta_table: pd.DataFrame) -> list:
+    """Return the columns of the section image table of a section in
+    `section_meta_table` that has images (or just "width" and "height",
+    the fields every sub-image has, if none of them do)."""
+    for sub_images in section_meta_table["sub_images"]:
+        # sections read from a table missing some sub_images hold NaN
+        if isinstance(sub_images, list) and len(sub_images) > 0:
+            img_dict = sub_images[0]
+            columns = [k for k in img_dict if k != "s3_data"]
+            return columns + list(img_dict["s3_data"])
+    return ["width", "height"]
+
+
+def _chunk_rows(rows: Iterator[dict], chunksize: int) -> Iterator[pd.DataFrame]:
+    """Yield DataFrames of (at most) `chunksize` rows from `rows`,
+    numbering the rows consecutively across chunks."""
+    start = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunksize))
+        if not chunk:
+            return
+        yield pd.DataFrame(chunk, index=range(start, start + len(chunk)))
+        start += len(chunk)
+
+
+def _section_image_rows(
+    sub_images: list,
+    local_save_directory: Optional[Path],
+    s3_client,
+    verbose: bool
+) -> Iterator[dict]:
+    """Yield one section image table row per entry of `sub_images`,
+    replacing its "s3_data" urls with ImagePromises."""
     for img_dict in sub_images:
-        new_img_dict = {**img_dict}
+        new_img_dict = {k: v for k, v in img_dict.items() if k != "s3_data"}
 
-        for k, v in new_img_dict["s3_data"].items():
+        for k, v in img_dict["s3_data"].items():
 
             # If user hasn't provided a local_save_directory then assume
             # we need to download from S3
@@ -209,15 +522,13 @@ def section_image_loader(
 
             new_img_dict[k] = image_promise
 
-        del new_img_dict["s3_data"]
-        loaded_sub_images.append(new_img_dict)
-
-    return pd.DataFrame(loaded_sub_images)
+        yield new_img_dict
 
 
 def local_section_metadata_loader(
     local_save_directory: Path,
-    verbose: bool = False
+    verbose: bool = False,
+    section_data_set_ids: Optional[Iterable[int]] = None
 ) -> pd.DataFrame:
     """
     Download and save the section metadata file to a local save directory.
@@ -231,7 +542,12 @@ def local_section_metadata_loader(
     verbose : bool
         Whether detailed information about what files are being
         downloaded or loaded should be shown.
-    
+    section_data_set_ids : Optional[Iterable[int]]
+        If provided, only the rows for these section_data_set_ids are
+        returned. When loading a previously downloaded file, rows are
+        filtered as the file is read, so the full table is never held
+        in memory.
+
     Returns
     -------
     pd.DataFrame
@@ -239,40 +555,77 @@ def local_section_metadata_loader(
     """
 
     s3_client = get_public_boto3_client()
-    
+
     if not local_save_directory.exists():
         local_save_directory.mkdir(parents=True, exist_ok=True)
-    
-    section_metadata_cache_loc = local_save_directory / "section_metadata.json"
+
+    if section_data_set_ids is not None:
+        section_data_set_ids = list(section_data_set_ids)
+
+    def _select(df: pd.DataFrame) -> pd.DataFrame:
+        if section_data_set_ids is None:
+            return df
+        return df[
+            df["section_data_set_id"].isin(section_data_set_ids)
+        ].reset_index(drop=True)
+
+    # The table is cached as JSON Lines (one record per line) so that it
+    # can be read back in chunks. Earlier versions cached it as a single
+    # JSON array in section_metadata.json; such a copy is converted
+    # rather than downloaded again.
+    section_metadata_cache_loc = local_save_directory / "section_metadata.jsonl"
+    legacy_cache_loc = local_save_directory / "section_metadata.json"
     if not section_metadata_cache_loc.exists():
-        # Download and cache section_metadata table since it is the
-        # only metadata of appreciable size (~56MB)
-        if verbose:
-            print(
-                f"Downloading section_metadata.json to "
-                f"{str(section_metadata_cache_loc)}\n"
-            )
-        section_metadata = get_section_metadata(s3_client)
+        if legacy_cache_loc.exists():
+            if verbose:
+                print(
+                    f"Converting {str(legacy_cache_loc)} to "
+                    f"{str(section_metadata_cache_loc)}\n"
+                )
+            section_metadata = pd.read_json(legacy_cache_loc)
+        else:
+            # Download and cache section_metadata table since it is the
+            # only metadata of appreciable size (~56MB)
+            if verbose:
+                print(
+                    f"Downloading section_metadata.json to "
+                    f"{str(section_metadata_cache_loc)}\n"
+                )
+            section_metadata = get_section_metadata(s3_client)
         section_metadata.to_json(
             section_metadata_cache_loc,
             orient="records",
-            indent=4
+            lines=True
         )
+        section_metadata = _select(section_metadata)
     else:
         if verbose:
             print(
                 f"Loading section_metadata.json from "
                 f"{str(section_metadata_cache_loc)}\n"
             )
-        section_metadata = pd.read_json(section_metadata_cache_loc)
-    
+        with pd.read_json(
+            section_metadata_cache_loc,
+            orient="records",
+            lines=True,
+            chunksize=_JSON_LINES_CHUNKSIZE
+        ) as reader:
+            chunks = [_select(chunk) for chunk in reader]
+        if chunks:
+            section_metadata = pd.concat(chunks, ignore_index=True)
+        else:
+            # an empty cache file holds no records (and so no columns)
+            section_metadata = pd.DataFrame()
+
     return section_metadata
 
 
 def section_image_downloader(
     local_save_directory: Path,
     section_data_set_id: int,
-    verbose: bool = False):
+    verbose: bool = False,
+    max_workers: int = 16,
+    clobber: bool = False):
     """
     Given a `local_save_directory` and a specific `section_data_set_id`
     download image data associated with the requested `section_data_set_id`
@@ -287,40 +640,74 @@ def section_image_downloader(
         A unique identifier for a section entry in the section_meta_table
     verbose:
         Whether this function should print updates on what it is downloading
+    max_workers:
+        The maximum number of images to download at the same time
+        (default: 16)
+    clobber:
+        If False (default), images that have already been saved to
+        `local_save_directory` are not downloaded again. If True, every
+        image is re-downloaded.
     """
 
     s3_client = get_public_boto3_client()
     
     section_metadata = local_section_metadata_loader(
-        local_save_directory, verbose=verbose
+        local_save_directory,
+        verbose=verbose,
+        section_data_set_ids=[section_data_set_id]
     )
     
-    try:
-        sub_images = section_metadata[
-            section_metadata["section_data_set_id"] == section_data_set_id
-        ]["sub_images"].iloc[0]
-    except IndexError as e:
-        e_msg = (
-            f"Could not find the `section_data_set_id` specified "
-            f"({section_data_set_id}) in the `section_meta_table` provided!"
-        )
-        raise RuntimeError(e_msg) from e
+    sub_images = _lookup_sub_images(section_metadata, section_data_set_id)
 
+    # Work out where every image goes (and create the parent directories)
+    # up front so that the download threads do not race to create them
+    downloads = []
     for img_dict in sub_images:
-        
+
         for k, v in img_dict["s3_data"].items():
-            rel_path = v.lstrip("s3://allen-ivy-glioblastoma-atlas/")
+            rel_path = _s3_url_to_key(v)
             local_save_path = local_save_directory / rel_path
-            
+
+            # images are only ever written to local_save_path once they
+            # have been completely downloaded (see _download), so an
+            # existing file is a complete copy
+            if not clobber and local_save_path.is_file():
+                if verbose:
+                    print(f"Skipping {v}, already saved to "
+                          f"{str(local_save_path)}\n")
+                continue
+
             # Create parent directories if they don't exist
             local_save_path.parent.mkdir(parents=True, exist_ok=True)
 
-            if verbose:
-                print(f"Saving image from {v} to {str(local_save_path)}\n")
-            
-            with local_save_path.open('wb') as fp:
+            downloads.append((v, rel_path, local_save_path))
+
+    def _download(s3_obj_url: str, rel_path: str, local_save_path: Path):
+        if verbose:
+            print(f"Saving image from {s3_obj_url} to {str(local_save_path)}\n")
+
+        # a name of its own, so that concurrent downloads of the same
+        # image (or the leftovers of a crashed one) cannot be mixed in
+        tmp_path = local_save_path.with_name(
+            f"{local_save_path.name}.{uuid.uuid4().hex}.part"
+        )
+        try:
+            with tmp_path.open('xb') as fp:
                 s3_client.download_fileobj(
-                    Bucket="allen-ivy-glioblastoma-atlas",
+                    Bucket=_BUCKET_NAME,
                     Key=rel_path,
-                    Fileobj=fp
+                    Fileobj=fp,
+                    Config=_TRANSFER_CONFIG
                 )
+            os.replace(tmp_path, local_save_path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    # boto3 clients are thread-safe, so all of the threads share one
+    # client (and its pool of connections)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_download, *args) for args in downloads]
+        for future in as_completed(futures):
+            # re-raise any exception from the download
+            future.result()
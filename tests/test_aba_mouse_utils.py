@@ -1,34 +1,169 @@
 import contextlib
 import hashlib
+import io
 import json
+import mmap
 import os
 import shutil
 import sys
 import tempfile
 import time
 import unittest
+import unittest.mock
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Tuple
 
+import boto3
+import numpy as np
+from botocore.exceptions import ClientError
 from PIL import Image
 
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
 import open_dataset_tools.aba_mouse_utils as mouse_utils
 from open_dataset_tools.aws_utils import get_public_boto3_client
 
 
-@contextlib.contextmanager
-def make_tmp_dir(auto_delete: bool = True):
-    tmp_dir_base = Path(__file__).resolve().parent / 'test_tmp'
+TEST_DIR = Path(__file__).resolve().parent
+
+# hand-checked copies of metadata that the tests compare against
+TEST_DATA_DIR = TEST_DIR / 'test_data'
+
+# Scratch files go in tests/test_tmp unless this environment variable
+# names another directory (e.g. one under /dev/shm, to keep the
+# downloads in RAM)
+TEST_TMP_ENV_VAR = 'OPEN_DATASET_TOOLS_TEST_TMP'
+
+# Large files downloaded by the tests are kept between test runs in
+# <scratch directory>/_cache unless this environment variable names
+# another directory (e.g. a persistent one, when the scratch directory
+# is in RAM)
+TEST_CACHE_ENV_VAR = 'OPEN_DATASET_TOOLS_TEST_CACHE'
+
+# Set this environment variable to '1' to skip the tests that talk to the
+# real allen-mouse-brain-atlas bucket (the moto-backed tests still run)
+SKIP_NETWORK_ENV_VAR = 'OPEN_DATASET_TOOLS_SKIP_NETWORK'
+
+skip_without_network = unittest.skipIf(
+    os.environ.get(SKIP_NETWORK_ENV_VAR) == '1',
+    '%s is set' % SKIP_NETWORK_ENV_VAR
+)
+
+
+# md5 checksum of the verified copy of section_data_sets.json
+ATLAS_METADATA_MD5 = '2c974e2be3a30a4d923f47dd4a7fde72'
+
+
+def get_tmp_dir_base() -> Path:
+    tmp_dir_base = os.environ.get(TEST_TMP_ENV_VAR)
+    if tmp_dir_base:
+        tmp_dir_base = Path(tmp_dir_base)
+    else:
+        tmp_dir_base = TEST_DIR / 'test_tmp'
     tmp_dir_base.mkdir(parents=True, exist_ok=True)
+    return tmp_dir_base
 
-    tmp_dir = Path(tempfile.mkdtemp(dir=tmp_dir_base))
 
+@contextlib.contextmanager
+def make_tmp_dir(auto_delete: bool = True):
+    tmp_dir_base = get_tmp_dir_base()
+
+    if not auto_delete:
+        yield Path(tempfile.mkdtemp(dir=tmp_dir_base))
+        return
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir_base) as tmp_dir:
+        yield Path(tmp_dir)
+
+
+def file_md5(fname: Path) -> str:
+    """
+    Return the hex md5 checksum of the file at fname, hashing the whole
+    file in C rather than line by line in Python
+    """
+    with fname.open('rb') as in_file:
+        if hasattr(hashlib, 'file_digest'):
+            # python >= 3.11
+            return hashlib.file_digest(in_file, mouse_utils._md5).hexdigest()
+
+        md5_obj = mouse_utils._md5()
+        if os.fstat(in_file.fileno()).st_size > 0:
+            # empty files cannot be mmapped
+            with mmap.mmap(in_file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    # the file is hashed front to back; let the OS read
+                    # ahead aggressively
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                md5_obj.update(mapped)
+        return md5_obj.hexdigest()
+
+
+def get_fixture_cache_dir() -> Path:
+    """
+    Return the directory in which large files downloaded by the tests
+    are kept between test runs (unlike the directories made by
+    make_tmp_dir, it is never deleted)
+    """
+    cache_dir = os.environ.get(TEST_CACHE_ENV_VAR)
+    if cache_dir:
+        cache_dir = Path(cache_dir)
+    else:
+        cache_dir = get_tmp_dir_base() / '_cache'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def restore_cached_fixture(fname: str, md5: str, tmp_dir: Path) -> bool:
+    """
+    If the fixture cache holds a copy of fname whose md5 checksum is md5,
+    link it (and its sidecar) into tmp_dir so that the code under test
+    finds it already downloaded. Return True if the copy was restored.
+    """
+    cached = get_fixture_cache_dir() / fname
+    if not cached.is_file() or file_md5(cached) != md5:
+        return False
+    cached_sidecar = mouse_utils._sidecar_path(cached)
+    if not cached_sidecar.is_file():
+        return False
     try:
-        yield tmp_dir
-    finally:
-        if auto_delete:
-            shutil.rmtree(tmp_dir)
-
+        os.link(cached, tmp_dir / fname)
+    except OSError:
+        # e.g. tmp_dir is on another file system
+        shutil.copy2(cached, tmp_dir / fname)
+    shutil.copy(cached_sidecar, mouse_utils._sidecar_path(tmp_dir / fname))
+    return True
+
+
+def store_cached_fixture(fname: str, tmp_dir: Path) -> None:
+    """
+    Copy the downloaded file tmp_dir/fname (and its sidecar) into the
+    fixture cache for later test runs
+    """
+    cached = get_fixture_cache_dir() / fname
+    shutil.copy2(tmp_dir / fname, cached)
+    shutil.copy(mouse_utils._sidecar_path(tmp_dir / fname),
+                mouse_utils._sidecar_path(cached))
+
+
+def is_valid_tiff(fname: Path) -> bool:
+    """
+    Return True if fname starts with a TIFF header and PIL can parse its
+    first image file directory. The pixel data is not decoded.
+    """
+    with fname.open('rb') as in_file:
+        if in_file.read(4) not in (b'II*\x00', b'MM\x00*'):
+            return False
+    with Image.open(fname) as img:
+        return img.format == 'TIFF' and img.width > 0 and img.height > 0
+
+
+@skip_without_network
 class MetadataTestCase(unittest.TestCase):
 
     @classmethod
@@ -47,29 +182,63 @@ class MetadataTestCase(unittest.TestCase):
         from a verified copy that was downloaded from S3 by hand.
         """
         with make_tmp_dir() as tmp_dir:
-            for s3_client in (self.s3_client, None):
-                metadata = mouse_utils.get_atlas_metadata(
-                    s3_client=s3_client,
-                    download_directory=tmp_dir
-                )
-
-                self.assertIsInstance(metadata, list)
-                self.assertEqual(len(metadata), 26078)
-                for obj in metadata:
-                    self.assertIsInstance(obj, dict)
+            # the file is many MB; after the first run, start from the
+            # copy kept in the fixture cache (which is still checked
+            # against S3's ETag by get_atlas_metadata)
+            restored = restore_cached_fixture('section_data_sets.json',
+                                              ATLAS_METADATA_MD5, tmp_dir)
+
+            metadata = mouse_utils.get_atlas_metadata(
+                s3_client=self.s3_client,
+                download_directory=tmp_dir
+            )
 
-                fname = tmp_dir / 'section_data_sets.json'
+            self.assertIsInstance(metadata, list)
+            self.assertEqual(len(metadata), 26078)
+            self.assertTrue(all(type(obj) is dict for obj in metadata))
+
+            fname = tmp_dir / 'section_data_sets.json'
+
+            if not fname.exists():
+                raise RuntimeError("Failed to download section_data_sets.json")
+
+            # the download is checked against S3's ETag (the object's md5)
+            # as it streams in, so the recorded ETag stands in for the
+            # file's checksum
+            sidecar = mouse_utils._read_sidecar(fname)
+            self.assertIsNotNone(sidecar)
+            self.assertEqual(sidecar['etag'], ATLAS_METADATA_MD5)
+            if not restored:
+                store_cached_fixture('section_data_sets.json', tmp_dir)
+
+            # without an s3_client, the copy that was just downloaded
+            # is reused
+            t0 = fname.stat().st_mtime_ns
+            metadata_no_client = mouse_utils.get_atlas_metadata(
+                s3_client=None,
+                download_directory=tmp_dir
+            )
+            self.assertEqual(len(metadata_no_client), len(metadata))
+            self.assertEqual(fname.stat().st_mtime_ns, t0)
 
-                if not fname.exists():
-                    raise RuntimeError("Failed to download section_data_sets.json")
+    def test_atlas_metadata_fresh_download(self):
+        """
+        Test downloading section_data_sets.json into an empty directory,
+        without starting from the copy in the fixture cache, so that the
+        whole download path (including the checksum of the streamed
+        bytes) is exercised on every run
+        """
+        with make_tmp_dir() as tmp_dir:
+            metadata = mouse_utils.get_atlas_metadata(
+                s3_client=self.s3_client,
+                download_directory=tmp_dir
+            )
+            self.assertEqual(len(metadata), 26078)
 
-                md5_obj = hashlib.md5()
-                with fname.open('rb') as in_file:
-                    for line in in_file:
-                        md5_obj.update(line)
-                checksum = md5_obj.hexdigest()
-                self.assertEqual(checksum,
-                                '2c974e2be3a30a4d923f47dd4a7fde72')
+            fname = tmp_dir / 'section_data_sets.json'
+            self.assertEqual(file_md5(fname), ATLAS_METADATA_MD5)
+            self.assertEqual(mouse_utils._read_sidecar(fname)['etag'],
+                             ATLAS_METADATA_MD5)
 
     def test_section_metadata(self):
         """
@@ -78,26 +247,82 @@ class MetadataTestCase(unittest.TestCase):
         """
         with make_tmp_dir() as tmp_dir:
             section_id = 99
-            for s3_client in (self.s3_client, None):
-                metadata = mouse_utils.get_section_metadata(
-                    section_id=section_id,
-                    download_directory=tmp_dir
-                )
+            metadata = mouse_utils.get_section_metadata(
+                section_id=section_id,
+                download_directory=tmp_dir,
+                s3_client=self.s3_client
+            )
+
+            self.assertIsInstance(metadata, dict)
 
-                self.assertIsInstance(metadata, dict)
+            fname = tmp_dir / f'section_data_set_{section_id}_metadata.json'
 
-                fname = tmp_dir / f'section_data_set_{section_id}_metadata.json'
+            if not fname.exists():
+                raise RuntimeError("Failed to download %s" % fname)
 
-                if not fname.exists():
-                    raise RuntimeError("Failed to download %s" % fname)
+            sidecar = mouse_utils._read_sidecar(fname)
+            self.assertIsNotNone(sidecar)
+            self.assertEqual(sidecar['etag'],
+                            'e8eff384bb39cc981f93bad62e6fad02')
 
-                md5_obj = hashlib.md5()
-                with fname.open('rb') as in_file:
-                    for line in in_file:
-                        md5_obj.update(line)
-                checksum = md5_obj.hexdigest()
-                self.assertEqual(checksum,
-                                'e8eff384bb39cc981f93bad62e6fad02')
+            # without an s3_client, the copy that was just downloaded
+            # is reused
+            t0 = fname.stat().st_mtime_ns
+            metadata_no_client = mouse_utils.get_section_metadata(
+                section_id=section_id,
+                download_directory=tmp_dir
+            )
+            self.assertEqual(metadata_no_client, metadata)
+            self.assertEqual(fname.stat().st_mtime_ns, t0)
+
+    def test_section_metadata_batch(self):
+        """
+        Test that downloading many sections' metadata in parallel gives
+        the same result as downloading them one at a time
+        """
+        section_ids = [99, 275693, 100055044]
+        with make_tmp_dir() as tmp_dir:
+            batch = mouse_utils.get_section_metadata_batch(
+                section_ids=section_ids,
+                download_directory=tmp_dir / 'batch',
+                s3_client=self.s3_client,
+                max_workers=3
+            )
+            self.assertEqual(len(batch), len(section_ids))
+            for section_id, metadata in zip(section_ids, batch):
+                control = mouse_utils.get_section_metadata(
+                    section_id=section_id,
+                    download_directory=tmp_dir / 'serial',
+                    s3_client=self.s3_client
+                )
+                self.assertEqual(metadata, control)
+
+    def test_atlas_metadata_for_section(self):
+        """
+        Test that the atlas metadata for a single section matches the
+        corresponding entry in the full atlas metadata
+        """
+        section_id = 100055044
+        with make_tmp_dir() as tmp_dir:
+            metadata = mouse_utils.get_atlas_metadata_for_section(
+                section_id=section_id,
+                download_directory=tmp_dir / 'single',
+                s3_client=self.s3_client
+            )
+            atlas = mouse_utils.get_atlas_metadata(
+                download_directory=tmp_dir / 'atlas',
+                s3_client=self.s3_client
+            )
+            control = [obj for obj in atlas if obj['id'] == section_id]
+            self.assertEqual(len(control), 1)
+            self.assertEqual(metadata, control[0])
+
+            with self.assertRaises(RuntimeError):
+                mouse_utils.get_atlas_metadata_for_section(
+                    section_id=-1,
+                    download_directory=tmp_dir / 'single',
+                    s3_client=self.s3_client
+                )
 
     def test_download_caching(self):
         """
@@ -109,89 +334,189 @@ class MetadataTestCase(unittest.TestCase):
             fname = tmp_dir / f'section_data_set_{section_id}_metadata.json'
             aws_name = f'section_data_set_{section_id}/section_data_set.json'
             self.assertFalse(fname.exists())
-            mouse_utils._get_aws_file(aws_name, fname, self.s3_client)
-            self.assertTrue(fname.exists)
+            self.assertIs(
+                mouse_utils._get_aws_file(aws_name, fname, self.s3_client),
+                True
+            )
+            self.assertTrue(fname.exists())
+            # backdate the file so that, if redownloaded, st_mtime_ns
+            # would differ
+            past = time.time() - 3600
+            os.utime(fname, (past, past))
             fstats = os.stat(fname)
             t0 = fstats.st_mtime_ns  # get the time of last modificatio in nanosec
-            time.sleep(2)  # wait so that, if redownloaded, st_mtime_ns would differ
-            mouse_utils._get_aws_file(aws_name, fname, self.s3_client)
+            # the file's checksum is compared against S3
+            self.assertIs(
+                mouse_utils._get_aws_file(aws_name, fname, self.s3_client),
+                False
+            )
             fstats = os.stat(fname)
             t1 = fstats.st_mtime_ns
             self.assertEqual(t1, t0)
 
+            # the file is now known to be current, so S3 is asked for it
+            # with If-None-Match and answers '304 Not Modified'
+            with unittest.mock.patch.object(
+                    self.s3_client, 'get_object',
+                    wraps=self.s3_client.get_object) as get_object:
+                self.assertIs(
+                    mouse_utils._get_aws_file(aws_name, fname, self.s3_client),
+                    False
+                )
+            self.assertEqual(get_object.call_count, 1)
+            self.assertIn('IfNoneMatch', get_object.call_args.kwargs)
+            self.assertEqual(os.stat(fname).st_mtime_ns, t0)
 
-class SectionDataSetTestCase(unittest.TestCase):
-
-    @classmethod
-    def setUpClass(cls):
-        # regarding warnings filter, see
-        # https://github.com/boto/boto3/issues/454#issuecomment-380900404
-        warnings.filterwarnings("ignore", category=ResourceWarning,
-                                message='unclosed <ssl.SSLSocket')
-        cls.s3_client = get_public_boto3_client()
-        cls.example_section_id = 275693
-
-    def test_metadata_from_tissue_index(self):
+    def test_download_max_age(self):
         """
-        Try loading the metadata by tissue_index.
-        Compare to a json dict of the expected result that was
-        copied to tests/test_data/ by hand.
+        Test that a recently verified local copy of the metadata is used
+        without contacting S3 when max_age is specified
         """
-
         with make_tmp_dir() as tmp_dir:
-            dataset = mouse_utils.SectionDataSet(
-                self.example_section_id,
+            section_id = 99
+            control = mouse_utils.get_section_metadata(
+                section_id=section_id,
                 download_directory=tmp_dir,
-                s3_client=self.s3_client           
+                s3_client=self.s3_client
             )
 
-            metadata = dataset.image_metadata_from_tissue_index(154)
-            control_file = (
-                Path(__file__).resolve().parent
-                / 'test_data'
-                / 'example_metadata_tissue_154.json'
+            # a client that fails on any request proves S3 is not queried
+            bad_client = object()
+            mouse_utils.clear_metadata_cache()
+            metadata = mouse_utils.get_section_metadata(
+                section_id=section_id,
+                download_directory=tmp_dir,
+                s3_client=bad_client,
+                max_age=3600
             )
-            with open(control_file, 'rb') as in_file:
-                control_metadata = json.load(in_file)
-            self.assertEqual(metadata, control_metadata)
+            self.assertEqual(metadata, control)
 
-            # try loading a bad value
-            with self.assertWarns(UserWarning) as bad_tissue:
-                metadata = dataset.image_metadata_from_tissue_index(999)
-            self.assertIsNone(metadata)
-            self.assertIn("tissue_index 999 does not exist",
-                        bad_tissue.warning.args[0])
+            mouse_utils.clear_metadata_cache()
+            with self.assertRaises(AttributeError):
+                mouse_utils.get_section_metadata(
+                    section_id=section_id,
+                    download_directory=tmp_dir,
+                    s3_client=bad_client,
+                    max_age=0
+                )
 
-    def test_metadata_from_sub_image(self):
+            # setting ABA_SKIP_REMOTE_CHECK trusts verified files forever
+            mouse_utils.clear_metadata_cache()
+            with unittest.mock.patch.dict(os.environ,
+                                          {'ABA_SKIP_REMOTE_CHECK': '1'}):
+                metadata = mouse_utils.get_section_metadata(
+                    section_id=section_id,
+                    download_directory=tmp_dir,
+                    s3_client=bad_client
+                )
+            self.assertEqual(metadata, control)
+
+    def test_metadata_memory_cache(self):
         """
-        Try loading the metadata by sub_image_id.
-        Compare to a json dict of the expected result that was
-        copied to tests/test_data/ by hand.
+        Test that metadata already loaded by this process is returned
+        without contacting S3, and that callers get independent copies
         """
-
         with make_tmp_dir() as tmp_dir:
-            dataset = mouse_utils.SectionDataSet(
-                self.example_section_id,
+            section_id = 99
+            control = mouse_utils.get_section_metadata(
+                section_id=section_id,
                 download_directory=tmp_dir,
                 s3_client=self.s3_client
             )
+            control['section_images'] = None
 
-            metadata = dataset.image_metadata_from_sub_image(102000022)
-            control_file = (
-                Path(__file__).resolve().parent
-                / 'test_data'
-                / 'example_metadata_id_102000022.json'
+            bad_client = object()
+            metadata = mouse_utils.get_section_metadata(
+                section_id=section_id,
+                download_directory=tmp_dir,
+                s3_client=bad_client
             )
+            self.assertIsInstance(metadata['section_images'], list)
+
+            mouse_utils.clear_metadata_cache()
+            with self.assertRaises(AttributeError):
+                mouse_utils.get_section_metadata(
+                    section_id=section_id,
+                    download_directory=tmp_dir,
+                    s3_client=bad_client
+                )
+
+
+@skip_without_network
+class SectionDataSetTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # regarding warnings filter, see
+        # https://github.com/boto/boto3/issues/454#issuecomment-380900404
+        warnings.filterwarnings("ignore", category=ResourceWarning,
+                                message='unclosed <ssl.SSLSocket')
+        cls.s3_client = get_public_boto3_client()
+        cls.example_section_id = 275693
+
+        # json dicts of expected metadata, copied to tests/test_data/
+        # by hand
+        cls.control_metadata = dict()
+        for control_name in ('example_metadata_tissue_154.json',
+                             'example_metadata_id_102000022.json',
+                             'section_data_set_100055044_metadata.json'):
+            control_file = TEST_DATA_DIR / control_name
             with open(control_file, 'rb') as in_file:
-                control_metadata = json.load(in_file)
-            self.assertEqual(metadata, control_metadata)
+                cls.control_metadata[control_name] = json.load(in_file)
+
+        # the tests only read from this dataset, so they share one copy
+        # (and one download of its metadata)
+        cls._tmp_dir_context = make_tmp_dir()
+        cls.tmp_dir = cls._tmp_dir_context.__enter__()
+
+        # fetch the metadata for every section used below in one
+        # parallel batch; datasets constructed with
+        # download_directory=cls.tmp_dir then find it already loaded
+        mouse_utils.get_section_metadata_batch(
+            (cls.example_section_id, 100055044, 100055049),
+            download_directory=cls.tmp_dir,
+            s3_client=cls.s3_client
+        )
+
+        cls.dataset = mouse_utils.SectionDataSet(
+            cls.example_section_id,
+            download_directory=cls.tmp_dir,
+            s3_client=cls.s3_client
+        )
 
-            # try loading a bad value
-            with self.assertWarns(UserWarning) as bad_tissue:
-                metadata = dataset.image_metadata_from_sub_image(999)
-            self.assertIsNone(metadata)
-            self.assertIn("sub_image 999 does not exist",
-                        bad_tissue.warning.args[0])
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp_dir_context.__exit__(None, None, None)
+
+    def test_metadata_lookups(self):
+        """
+        Try loading the metadata by tissue_index and by sub_image_id.
+        Compare to json dicts of the expected results that were
+        copied to tests/test_data/ by hand.
+        """
+        dataset = self.dataset
+
+        cases = [
+            ('image_metadata_from_tissue_index', 154,
+             'example_metadata_tissue_154.json', 'tissue_index'),
+            ('image_metadata_from_sub_image', 102000022,
+             'example_metadata_id_102000022.json', 'sub_image')
+        ]
+
+        for method_name, key, control_name, key_name in cases:
+            with self.subTest(method_name):
+                lookup = getattr(dataset, method_name)
+
+                metadata = lookup(key)
+                self.assertEqual(metadata,
+                                 self.control_metadata[control_name])
+
+                # try loading a bad value
+                with self.assertWarns(UserWarning) as bad_lookup:
+                    metadata = lookup(999)
+                self.assertIsNone(metadata)
+                self.assertIn(f"{key_name} 999 does not exist",
+                              bad_lookup.warning.args[0])
 
     def test_bad_tier_image_download(self):
         """
@@ -199,34 +524,30 @@ class SectionDataSetTestCase(unittest.TestCase):
         download images from tiers that do not exist
         """
         with make_tmp_dir() as tmp_dir:
-            dataset = mouse_utils.SectionDataSet(
-                self.example_section_id,
-                download_directory=tmp_dir,
-                s3_client=self.s3_client
-            )
+            dataset = self.dataset
 
             # verify what happens when you ask for a resolution
             # that does not exist
             tiff_name = tmp_dir / 'junk.tiff'
-            with self.assertWarns(UserWarning) as bad_image:
-                res = dataset.download_image_from_tissue_index(66,
-                                                            0,
-                                                            tiff_name)
-            self.assertIs(res, False)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always", UserWarning)
+                res_tissue = dataset.download_image_from_tissue_index(
+                    66, 0, tiff_name)
+                res_sub_image = dataset.download_image_from_sub_image(
+                    102000016, 0, tiff_name)
+
+            self.assertIs(res_tissue, False)
+            self.assertIs(res_sub_image, False)
             self.assertFalse(tiff_name.exists())
-            self.assertIn("0 is not a valid downsampling tier",
-                        bad_image.warning.args[0])
+            bad_images = [w for w in caught
+                          if issubclass(w.category, UserWarning)]
+            self.assertEqual(len(bad_images), 2)
+            for bad_image in bad_images:
+                self.assertIn("0 is not a valid downsampling tier",
+                              str(bad_image.message))
+
             metadata = dataset.image_metadata_from_tissue_index(66)
             self.assertNotIn('downsample_0', metadata)
-
-            with self.assertWarns(UserWarning) as bad_image:
-                res = dataset.download_image_from_sub_image(102000016,
-                                                            0,
-                                                            tiff_name)
-            self.assertIs(res, False)
-            self.assertFalse(tiff_name.exists())
-            self.assertIn("0 is not a valid downsampling tier",
-                        bad_image.warning.args[0])
             metadata = dataset.image_metadata_from_sub_image(102000016)
             self.assertNotIn('downsample_0', metadata)
 
@@ -237,32 +558,43 @@ class SectionDataSetTestCase(unittest.TestCase):
         that do not exist
         """
         with make_tmp_dir() as tmp_dir:
-            dataset = mouse_utils.SectionDataSet(
-                self.example_section_id,
-                download_directory=tmp_dir,
-                s3_client=self.s3_client
-            )
+            dataset = self.dataset
 
             # verify what happens when you ask for a resolution
             # that does not exist
             tiff_name = tmp_dir / 'junk2.tiff'
-            with self.assertWarns(UserWarning) as bad_image:
-                res = dataset.download_image_from_tissue_index(999,
-                                                            4,
-                                                            tiff_name)
-            self.assertIs(res, False)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always", UserWarning)
+                res_tissue = dataset.download_image_from_tissue_index(
+                    999, 4, tiff_name)
+                res_sub_image = dataset.download_image_from_sub_image(
+                    999, 4, tiff_name)
+
+            self.assertIs(res_tissue, False)
+            self.assertIs(res_sub_image, False)
             self.assertFalse(tiff_name.exists())
+            bad_images = [w for w in caught
+                          if issubclass(w.category, UserWarning)]
+            self.assertEqual(len(bad_images), 2)
             self.assertIn("tissue_index 999 does not exist",
-                        bad_image.warning.args[0])
-
-            with self.assertWarns(UserWarning) as bad_image:
-                res = dataset.download_image_from_sub_image(999,
-                                                            4,
-                                                            tiff_name)
-            self.assertIs(res, False)
-            self.assertFalse(tiff_name.exists())
+                          str(bad_images[0].message))
             self.assertIn("sub_image 999 does not exist",
-                        bad_image.warning.args[0])
+                          str(bad_images[1].message))
+
+            # the warnings can be suppressed for bulk scans
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                res = dataset.download_image_from_tissue_index(
+                    999, 4, tiff_name, warn=False)
+                self.assertIs(res, False)
+                res = dataset.download_image_from_sub_image(
+                    999, 4, tiff_name, warn=False)
+                self.assertIs(res, False)
+                self.assertIsNone(
+                    dataset.image_metadata_from_tissue_index(999, warn=False))
+                self.assertIsNone(
+                    dataset.image_metadata_from_sub_image(999, warn=False))
+            self.assertFalse(tiff_name.exists())
 
     def test_good_tier_image_download(self):
         """
@@ -272,61 +604,78 @@ class SectionDataSetTestCase(unittest.TestCase):
         with make_tmp_dir() as tmp_dir:
             dset_1 = mouse_utils.SectionDataSet(
                 100055044,
-                download_directory=tmp_dir,
+                download_directory=self.tmp_dir,
                 s3_client=self.s3_client
             )
-
-            # try downloading good files
-            tiff_name = tmp_dir / 'tiss_13.tiff'
-            self.assertFalse(tiff_name.exists())
-            res = dset_1.download_image_from_tissue_index(13, 4, tiff_name)
-            self.assertIs(res, True)
-            self.assertTrue(tiff_name.exists())
-            # make sure image is valid
-            f = Image.open(tiff_name)
-            f.load()
-            f.close()
-
             dset_2 = mouse_utils.SectionDataSet(
                 100055049,
-                download_directory=tmp_dir,
+                download_directory=self.tmp_dir,
                 s3_client=self.s3_client
             )
 
-            # try downloading good files
-            tiff_name = tmp_dir / 'tiss_101082398.tiff'
-            self.assertFalse(tiff_name.exists())
-            res = dset_2.download_image_from_sub_image(101082398, 4, tiff_name)
-            self.assertIs(res, True)
-            self.assertTrue(tiff_name.exists())
-            # make sure image is valid
-            f = Image.open(tiff_name)
-            f.load()
-            f.close()
+            tiff_name_1 = tmp_dir / 'tiss_13.tiff'
+            tiff_name_2 = tmp_dir / 'tiss_101082398.tiff'
+            self.assertFalse(tiff_name_1.exists())
+            self.assertFalse(tiff_name_2.exists())
+
+            # try downloading good files (at the same time, since the
+            # downloads are independent)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                future_1 = executor.submit(
+                    dset_1.download_image_from_tissue_index,
+                    13, 4, tiff_name_1
+                )
+                future_2 = executor.submit(
+                    dset_2.download_image_from_sub_image,
+                    101082398, 4, tiff_name_2
+                )
+                res_1 = future_1.result()
+                res_2 = future_2.result()
 
-    def test_clobber_tissue_index(self):
+            for res, tiff_name in ((res_1, tiff_name_1),
+                                   (res_2, tiff_name_2)):
+                self.assertIs(res, True)
+                self.assertTrue(tiff_name.exists())
+                # make sure image is valid
+                self.assertTrue(is_valid_tiff(tiff_name))
+
+    def test_bulk_image_download(self):
         """
-        Test behavior of clobber kwarg in methods to download images
+        Test downloading several images from a SectionDataSet at once
         """
         with make_tmp_dir() as tmp_dir:
             dataset = mouse_utils.SectionDataSet(
-                self.example_section_id,
-                download_directory=tmp_dir,
+                100055044,
+                download_directory=self.tmp_dir,
                 s3_client=self.s3_client
             )
 
+            with self.assertWarns(UserWarning):
+                results = dataset.download_images_bulk(
+                    [13, 29, 999], 4, tmp_dir / 'bulk', max_workers=2
+                )
+            self.assertEqual(results, {13: True, 29: True, 999: False})
+            for tissue_index in (13, 29):
+                tiff_name = (
+                    tmp_dir / 'bulk' /
+                    f'section_data_set_100055044_tissue_{tissue_index}_downsample_4.tiff'
+                )
+                # make sure image is valid
+                self.assertTrue(is_valid_tiff(tiff_name))
+
+    def test_clobber_tissue_index(self):
+        """
+        Test behavior of clobber kwarg in methods to download images
+        """
+        with make_tmp_dir() as tmp_dir:
+            dataset = self.dataset
+
             tiff_name = tmp_dir / 'clobber.tiff'
             res = dataset.download_image_from_tissue_index(58, 5, tiff_name)
             self.assertIs(res, True)
 
-            md5_obj = hashlib.md5()
-            with open(tiff_name, 'rb') as in_file:
-                while True:
-                    data = in_file.read(10000)
-                    if len(data) == 0:
-                        break
-                    md5_obj.update(data)
-            md5_0 = md5_obj.hexdigest()
+            md5_0 = file_md5(tiff_name)
+            stat_0 = tiff_name.stat()
 
             # try downloading to the same file without clobber
             with self.assertWarns(UserWarning) as bad_download:
@@ -337,16 +686,11 @@ class SectionDataSetTestCase(unittest.TestCase):
             self.assertIn('%s already exists' % tiff_name,
                         bad_download.warning.args[0])
 
-            # check that no new file was downloaded
-            md5_obj = hashlib.md5()
-            with open(tiff_name, 'rb') as in_file:
-                while True:
-                    data = in_file.read(10000)
-                    if len(data) == 0:
-                        break
-                    md5_obj.update(data)
-            md5_1 = md5_obj.hexdigest()
-            self.assertEqual(md5_0, md5_1)
+            # check that no new file was downloaded (writing to the file
+            # would have changed its st_mtime_ns)
+            stat_1 = tiff_name.stat()
+            self.assertEqual((stat_1.st_mtime_ns, stat_1.st_size),
+                             (stat_0.st_mtime_ns, stat_0.st_size))
 
             # rerun with clobber
             res = dataset.download_image_from_tissue_index(
@@ -355,14 +699,7 @@ class SectionDataSetTestCase(unittest.TestCase):
             self.assertIs(res, True)
 
             # check that a new file was downloaded
-            md5_obj = hashlib.md5()
-            with open(tiff_name, 'rb') as in_file:
-                while True:
-                    data = in_file.read(10000)
-                    if len(data) == 0:
-                        break
-                    md5_obj.update(data)
-            md5_2 = md5_obj.hexdigest()
+            md5_2 = file_md5(tiff_name)
             self.assertNotEqual(md5_0, md5_2)
 
     def test_clobber_sub_image(self):
@@ -370,25 +707,15 @@ class SectionDataSetTestCase(unittest.TestCase):
         Test behavior of clobber kwarg in methods to download images
         """
         with make_tmp_dir() as tmp_dir:
-            dataset = mouse_utils.SectionDataSet(
-                self.example_section_id,
-                download_directory=tmp_dir,
-                s3_client=self.s3_client
-            )
+            dataset = self.dataset
 
             tiff_name = tmp_dir / 'clobber2.tiff'
             res = dataset.download_image_from_sub_image(102000002,
                                                         5, tiff_name)
             self.assertIs(res, True)
 
-            md5_obj = hashlib.md5()
-            with open(tiff_name, 'rb') as in_file:
-                while True:
-                    data = in_file.read(1000)
-                    if len(data) == 0:
-                        break
-                    md5_obj.update(data)
-            md5_0 = md5_obj.hexdigest()
+            md5_0 = file_md5(tiff_name)
+            stat_0 = tiff_name.stat()
 
             # try downloading to the same file without clobber
             with self.assertWarns(UserWarning) as bad_download:
@@ -400,16 +727,11 @@ class SectionDataSetTestCase(unittest.TestCase):
             self.assertIn('%s already exists' % tiff_name,
                         bad_download.warning.args[0])
 
-            # check that no new file was downloaded
-            md5_obj = hashlib.md5()
-            with open(tiff_name, 'rb') as in_file:
-                while True:
-                    data = in_file.read(1000)
-                    if len(data) == 0:
-                        break
-                    md5_obj.update(data)
-                md5_1 = md5_obj.hexdigest()
-            self.assertEqual(md5_0, md5_1)
+            # check that no new file was downloaded (writing to the file
+            # would have changed its st_mtime_ns)
+            stat_1 = tiff_name.stat()
+            self.assertEqual((stat_1.st_mtime_ns, stat_1.st_size),
+                             (stat_0.st_mtime_ns, stat_0.st_size))
 
             # rerun with clobber
             res = dataset.download_image_from_sub_image(102000008, 4, tiff_name,
@@ -417,14 +739,7 @@ class SectionDataSetTestCase(unittest.TestCase):
             self.assertIs(res, True)
 
             # check that a new file was downloaded
-            md5_obj = hashlib.md5()
-            with open(tiff_name, 'rb') as in_file:
-                while True:
-                    data = in_file.read(1000)
-                    if len(data) == 0:
-                        break
-                    md5_obj.update(data)
-            md5_2 = md5_obj.hexdigest()
+            md5_2 = file_md5(tiff_name)
             self.assertNotEqual(md5_0, md5_2)
 
     def test_download_into_not_a_file(self):
@@ -435,11 +750,7 @@ class SectionDataSetTestCase(unittest.TestCase):
 
         with make_tmp_dir() as tmp_dir:
             tiff_name = Path(tempfile.mkdtemp(dir=tmp_dir))
-            dataset = mouse_utils.SectionDataSet(
-                self.example_section_id,
-                download_directory=tmp_dir,
-                s3_client=self.s3_client
-            )
+            dataset = self.dataset
 
             with self.assertWarns(UserWarning) as bad_download:
                 res = dataset.download_image_from_sub_image(102000002,
@@ -465,55 +776,600 @@ class SectionDataSetTestCase(unittest.TestCase):
         Test the contents of SectionDataSet.sub_image_ids
         and SectionDataSet.tissue_indices
         """
+        dataset = self.dataset
+
+        control = (102000002, 102000006,
+                102000008, 102000010, 102000012, 102000014,
+                102000016, 102000018, 102000020, 102000022,
+                102000024, 102000026, 102000028, 102000032,
+                102000034, 102000036, 102000038)
+
+        self.assertEqual(tuple(dataset.sub_image_ids), control)
+
+        control = (10, 26, 34, 42, 50, 58, 66, 74, 82, 90, 98,
+                106, 114, 130, 138, 146, 154)
+
+        self.assertEqual(tuple(dataset.tissue_indices), control)
+
+    def test_many_sub_images(self):
+        """
+        Test that metadata is properly loaded when one TIFF contains
+        many sub-images
+        """
+        section_id = 100055044
+        dataset = mouse_utils.SectionDataSet(
+            section_id,
+            download_directory=self.tmp_dir,
+            s3_client=self.s3_client
+        )
+
+        control_metadata = self.control_metadata[
+            'section_data_set_100055044_metadata.json'
+        ]
+
+        for control_img in control_metadata['section_images']:
+            tissue_index = control_img['section_number']
+            subimg_id = control_img['id']
+            test = dataset.image_metadata_from_tissue_index(tissue_index)
+            self.assertEqual(control_img, test)
+            test = dataset.image_metadata_from_sub_image(subimg_id)
+            self.assertEqual(control_img, test)
+
+
+class ChecksumTestCase(unittest.TestCase):
+
+    def test_compare_md5_large_file(self):
+        """
+        Test _compare_md5 on files larger than one chunk, which are read
+        ahead by a separate thread (in more chunks than there are
+        buffers, so that the buffers are reused), against hashlib
+        """
+        chunk_size = mouse_utils._HASH_CHUNK_SIZE
+        rng = np.random.default_rng(22)
         with make_tmp_dir() as tmp_dir:
-            dataset = mouse_utils.SectionDataSet(
-                self.example_section_id,
+            fname = tmp_dir / 'data.bin'
+            for size in (chunk_size + 1,
+                         (mouse_utils._HASH_READ_AHEAD + 1) * chunk_size,
+                         (mouse_utils._HASH_READ_AHEAD + 1) * chunk_size
+                         + 12345):
+                with self.subTest(size=size):
+                    data = rng.bytes(size)
+                    fname.write_bytes(data)
+                    expected = mouse_utils._md5(data).hexdigest()
+                    self.assertTrue(mouse_utils._compare_md5(fname, expected))
+                    self.assertFalse(
+                        mouse_utils._compare_md5(fname, '0' * 32)
+                    )
+
+
+class _RangeOnlyS3Client(object):
+    """
+    Stands in for a boto3 S3 client serving a single file, answering
+    only the byte-range GetObject requests made by _S3RangeReader, and
+    recording the (first, last + 1) byte span of each
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.etag = hashlib.md5(data).hexdigest()
+        self.requests = []
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        if IfMatch is not None and IfMatch != '"%s"' % self.etag:
+            raise RuntimeError('ETag mismatch')
+        (first, last) = (int(i) for i in Range[len('bytes='):].split('-'))
+        last = min(last, len(self.data) - 1)
+        self.requests.append((first, last + 1))
+        return {
+            'ETag': '"%s"' % self.etag,
+            'ContentRange': 'bytes %d-%d/%d' % (first, last, len(self.data)),
+            'Body': io.BytesIO(self.data[first:last + 1])
+        }
+
+
+class PartialTiffReadTestCase(unittest.TestCase):
+    """
+    Tests of reading (parts of) TIFFs through _S3RangeReader, which need
+    no network access
+    """
+
+    box = (37, 45, 250, 170)
+
+    def _tiff_bytes(
+        self, mode: str, **save_kwargs
+    ) -> Tuple[bytes, Image.Image]:
+        shape = (200, 300) if mode == 'L' else (200, 300, 3)
+        pixels = (
+            np.random.default_rng(0).integers(0, 256, size=shape)
+            .astype(np.uint8)
+        )
+        img = Image.fromarray(pixels, mode)
+        buf = io.BytesIO()
+        img.save(buf, format='TIFF', **save_kwargs)
+        return (buf.getvalue(), img)
+
+    def test_multi_strip_crop(self):
+        """
+        Test cropping an uncompressed TIFF stored as many strips, only
+        some of which are downloaded
+        """
+        (data, expected) = self._tiff_bytes('L', tiffinfo={278: 16})
+        client = _RangeOnlyS3Client(data)
+        with unittest.mock.patch.object(mouse_utils, '_RANGE_READ_SIZE', 1024):
+            with mouse_utils._S3RangeReader(client, 'bucket', 'key') as reader:
+                with Image.open(reader) as img:
+                    self.assertGreater(len(img.tile), 2)
+                    self.assertTrue(
+                        mouse_utils._fetch_raw_tiles(img, reader, self.box)
+                    )
+                    cropped = img.crop(self.box)
+        self.assertEqual(cropped.tobytes(), expected.crop(self.box).tobytes())
+
+        n_bytes = sum(last - first for (first, last) in client.requests)
+        self.assertLess(n_bytes, len(data))
+
+    def test_compressed_download(self):
+        """
+        Test that a compressed TIFF is not read in part, and that
+        downloading it in full reuses the bytes read when it was opened
+        """
+        (data, expected) = self._tiff_bytes('RGB', compression='tiff_lzw')
+        client = _RangeOnlyS3Client(data)
+        transfer_config = mouse_utils.TransferConfig(
+            multipart_chunksize=len(data) // 5, max_concurrency=3
+        )
+        with unittest.mock.patch.object(mouse_utils, '_RANGE_READ_SIZE',
+                                        len(data) // 4):
+            with mouse_utils._S3RangeReader(client, 'bucket', 'key') as reader:
+                with Image.open(reader) as img:
+                    self.assertFalse(
+                        mouse_utils._fetch_raw_tiles(img, reader, self.box)
+                    )
+                n_header_requests = len(client.requests)
+                buf = io.BytesIO()
+                reader.download_to(buf, transfer_config)
+
+        self.assertEqual(buf.getvalue(), data)
+        with Image.open(buf) as img:
+            self.assertEqual(img.tobytes(), expected.tobytes())
+
+        # the start of the file was only requested when it was opened,
+        # and the rest of it is downloaded exactly once
+        self.assertEqual([first for (first, _) in client.requests].count(0), 1)
+        downloaded = sorted(client.requests[n_header_requests:])
+        self.assertEqual(downloaded[0][0], len(data) // 4)
+        self.assertEqual(downloaded[-1][1], len(data))
+        for (span, next_span) in zip(downloaded, downloaded[1:]):
+            self.assertEqual(span[1], next_span[0])
+
+
+@unittest.skipIf(mock_aws is None, 'moto is not installed')
+class MockedS3TestCase(unittest.TestCase):
+    """
+    Tests that run against a moto-mocked copy of (part of) the
+    allen-mouse-brain-atlas bucket, so that they need no network access
+    """
+
+    bucket_name = 'allen-mouse-brain-atlas'
+    section_id = 100055044
+
+    def setUp(self):
+        env = unittest.mock.patch.dict(os.environ, {
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1'
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        mouse_utils.clear_metadata_cache()
+        self.addCleanup(mouse_utils.clear_metadata_cache)
+
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=self.bucket_name)
+
+        control_file = (
+            TEST_DATA_DIR / f'section_data_set_{self.section_id}_metadata.json'
+        )
+        with open(control_file, 'rb') as in_file:
+            self.section_metadata = json.load(in_file)
+        self.atlas_metadata = [{'id': self.section_id}, {'id': 99}]
+
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key='section_data_sets.json',
+            Body=json.dumps(self.atlas_metadata).encode('utf-8')
+        )
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=f'section_data_set_{self.section_id}/section_data_set.json',
+            Body=json.dumps(self.section_metadata).encode('utf-8')
+        )
+
+    def test_atlas_metadata(self):
+        """
+        Test downloading, caching and re-validating the atlas metadata
+        """
+        with make_tmp_dir() as tmp_dir:
+            metadata = mouse_utils.get_atlas_metadata(
                 download_directory=tmp_dir,
                 s3_client=self.s3_client
             )
+            self.assertEqual(metadata, self.atlas_metadata)
+
+            fname = tmp_dir / 'section_data_sets.json'
+            sidecar = mouse_utils._read_sidecar(fname)
+            self.assertIsNotNone(sidecar)
+            self.assertEqual(sidecar['etag'], file_md5(fname))
+
+            # the local copy is current, so it is not downloaded again
+            self.assertIs(
+                mouse_utils._get_aws_file('section_data_sets.json', fname,
+                                          self.s3_client),
+                False
+            )
 
-            control = [102000002, 102000006,
-                    102000008, 102000010, 102000012, 102000014,
-                    102000016, 102000018, 102000020, 102000022,
-                    102000024, 102000026, 102000028, 102000032,
-                    102000034, 102000036, 102000038]
+            # but it is once the object in S3 changes
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key='section_data_sets.json',
+                Body=json.dumps(self.atlas_metadata[:1]).encode('utf-8')
+            )
+            self.assertIs(
+                mouse_utils._get_aws_file('section_data_sets.json', fname,
+                                          self.s3_client),
+                True
+            )
+            with open(fname, 'rb') as in_file:
+                self.assertEqual(json.load(in_file), self.atlas_metadata[:1])
 
-            self.assertEqual(dataset.sub_image_ids, control)
+    def test_metadata_memory_cache_max_age(self):
+        """
+        Test that the metadata held in memory is only used without
+        checking S3 when max_age allows it, and that a new version of the
+        file in S3 replaces it
+        """
+        with make_tmp_dir() as tmp_dir:
+            mouse_utils.get_atlas_metadata(
+                download_directory=tmp_dir, s3_client=self.s3_client
+            )
+            for (max_age, n_requests) in ((None, 0), (3600, 0), (0, 1)):
+                with self.subTest(max_age=max_age), unittest.mock.patch.object(
+                    self.s3_client, 'get_object',
+                    wraps=self.s3_client.get_object
+                ) as get_object:
+                    metadata = mouse_utils.get_atlas_metadata(
+                        download_directory=tmp_dir,
+                        s3_client=self.s3_client,
+                        max_age=max_age
+                    )
+                self.assertEqual(metadata, self.atlas_metadata)
+                self.assertEqual(get_object.call_count, n_requests)
+
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key='section_data_sets.json',
+                Body=json.dumps(self.atlas_metadata[:1]).encode('utf-8')
+            )
+            for max_age in (0, None):
+                metadata = mouse_utils.get_atlas_metadata(
+                    download_directory=tmp_dir,
+                    s3_client=self.s3_client,
+                    max_age=max_age
+                )
+                self.assertEqual(metadata, self.atlas_metadata[:1])
 
-            control = [10, 26, 34, 42, 50, 58, 66, 74, 82, 90, 98,
-                    106, 114, 130, 138, 146, 154]
+    def test_atlas_metadata_for_section(self):
+        """
+        Test looking up one section's atlas metadata with S3 Select,
+        and falling back to the full file when Select is not available
+        """
+        with make_tmp_dir() as tmp_dir:
+            expected = [obj for obj in mouse_utils.get_atlas_metadata(
+                download_directory=tmp_dir / 'full',
+                s3_client=self.s3_client
+            ) if obj['id'] == self.section_id][0]
 
-            self.assertEqual(dataset.tissue_indices, control)
+            not_implemented = ClientError(
+                {'Error': {'Code': 'NotImplemented',
+                           'Message': 'S3 Select is not supported'}},
+                'SelectObjectContent'
+            )
+            with unittest.mock.patch.object(
+                self.s3_client, 'select_object_content',
+                side_effect=not_implemented
+            ) as select:
+                metadata = mouse_utils.get_atlas_metadata_for_section(
+                    self.section_id,
+                    download_directory=tmp_dir / 'fallback',
+                    s3_client=self.s3_client
+                )
+            select.assert_called_once()
+            self.assertEqual(metadata, expected)
+            self.assertTrue(
+                (tmp_dir / 'fallback' / 'section_data_sets.json').is_file()
+            )
 
-    def test_many_sub_images(self):
+            # the records S3 Select streams back are newline-delimited
+            # JSON, possibly split across several events
+            payload = json.dumps(expected).encode('utf-8') + b'\n'
+            events = [
+                {'Records': {'Payload': payload[:5]}},
+                {'Records': {'Payload': payload[5:]}},
+                {'Stats': {}},
+                {'End': {}}
+            ]
+            with unittest.mock.patch.object(
+                self.s3_client, 'select_object_content',
+                return_value={'Payload': events}
+            ):
+                metadata = mouse_utils.get_atlas_metadata_for_section(
+                    self.section_id,
+                    download_directory=tmp_dir / 'select',
+                    s3_client=self.s3_client
+                )
+            self.assertEqual(metadata, expected)
+            self.assertFalse((tmp_dir / 'select').exists())
+
+            with unittest.mock.patch.object(
+                self.s3_client, 'select_object_content',
+                side_effect=not_implemented
+            ):
+                with self.assertRaises(RuntimeError):
+                    mouse_utils.get_atlas_metadata_for_section(
+                        12345,
+                        download_directory=tmp_dir / 'fallback',
+                        s3_client=self.s3_client
+                    )
+
+    def test_missing_metadata(self):
         """
-        Test that metadata is properly loaded when one TIFF contains
-        many sub-images
+        Test that asking for a file that is not in S3 raises an error
+        """
+        with make_tmp_dir() as tmp_dir:
+            with self.assertRaises(RuntimeError):
+                mouse_utils.get_section_metadata(
+                    section_id=99,
+                    download_directory=tmp_dir,
+                    s3_client=self.s3_client
+                )
+
+    def test_image_download(self):
+        """
+        Test downloading (and cropping) a section image
         """
+        tissue_index = 13
+        dataset_metadata = self.section_metadata['section_images']
+        img_metadata = [img for img in dataset_metadata
+                        if img['section_number'] == tissue_index][0]
+        tier_metadata = img_metadata['downsampling']['downsample_4']
+
+        tiff = Image.new(
+            'RGB',
+            (tier_metadata['image_file_width'],
+             tier_metadata['image_file_height']),
+            color=(10, 20, 30)
+        )
         with make_tmp_dir() as tmp_dir:
-            section_id = 100055044
+            tiff.save(tmp_dir / 'full.tiff')
+            self.s3_client.upload_file(
+                str(tmp_dir / 'full.tiff'),
+                self.bucket_name,
+                'section_data_set_%d/downsample_4/%s'
+                % (self.section_id, img_metadata['image_file_name'])
+            )
+
             dataset = mouse_utils.SectionDataSet(
-                section_id,
+                self.section_id,
                 download_directory=tmp_dir,
                 s3_client=self.s3_client
             )
+            tiff_name = tmp_dir / 'tissue.tiff'
+            res = dataset.download_image_from_tissue_index(
+                tissue_index, 4, tiff_name
+            )
+            self.assertIs(res, True)
+            self.assertTrue(is_valid_tiff(tiff_name))
+            with Image.open(tiff_name) as img:
+                self.assertEqual(
+                    img.size,
+                    (tier_metadata['width'], tier_metadata['height'])
+                )
+                self.assertEqual(img.getpixel((0, 0)), (10, 20, 30))
 
-            control_file = (
-                Path(__file__).resolve().parent
-                / 'test_data'
-                / 'section_data_set_100055044_metadata.json'
+    def test_multipart_etag(self):
+        """
+        Test checking a local copy of an object uploaded in several parts,
+        whose ETag is not an md5 checksum: a copy of the right size is
+        kept, and one of the wrong size is downloaded again
+        """
+        part_size = 5 * 1024 * 1024  # the smallest part S3 allows
+        data = np.random.default_rng(2).bytes(part_size + 1000)
+        aws_key = 'multipart.bin'
+        with make_tmp_dir() as tmp_dir:
+            (tmp_dir / 'upload.bin').write_bytes(data)
+            self.s3_client.upload_file(
+                str(tmp_dir / 'upload.bin'), self.bucket_name, aws_key,
+                Config=mouse_utils.TransferConfig(
+                    multipart_threshold=part_size,
+                    multipart_chunksize=part_size
+                )
             )
-            with open(control_file, 'rb') as in_file:
-                control_metadata = json.load(in_file)
-
-            for control_img in control_metadata['section_images']:
-                tissue_index = control_img['section_number']
-                subimg_id = control_img['id']
-                test = dataset.image_metadata_from_tissue_index(tissue_index)
-                print(test)
-                self.assertEqual(control_img, test)
-                test = dataset.image_metadata_from_sub_image(subimg_id)
-                self.assertEqual(control_img, test)
+            etag = self.s3_client.head_object(
+                Bucket=self.bucket_name, Key=aws_key
+            )['ETag'].strip('"')
+            self.assertFalse(mouse_utils._is_md5_etag(etag))
+
+            # same size, no sidecar: trusted without downloading
+            fname = tmp_dir / 'local.bin'
+            fname.write_bytes(data)
+            with unittest.mock.patch.object(
+                self.s3_client, 'get_object',
+                wraps=self.s3_client.get_object
+            ) as get_object:
+                self.assertIs(
+                    mouse_utils._get_aws_file(aws_key, fname, self.s3_client),
+                    False
+                )
+            get_object.assert_not_called()
+            self.assertEqual(mouse_utils._read_sidecar(fname)['etag'], etag)
+
+            # wrong size, no sidecar: downloaded again
+            mouse_utils._sidecar_path(fname).unlink()
+            fname.write_bytes(data[:-1])
+            self.assertIs(
+                mouse_utils._get_aws_file(aws_key, fname, self.s3_client),
+                True
+            )
+            self.assertEqual(fname.read_bytes(), data)
+            self.assertEqual(mouse_utils._read_sidecar(fname)['etag'], etag)
+
+    def test_bulk_download_duplicates(self):
+        """
+        Test that a tissue_index listed more than once is only
+        downloaded once by download_images_bulk
+        """
+        with make_tmp_dir() as tmp_dir:
+            dataset = mouse_utils.SectionDataSet(
+                self.section_id,
+                download_directory=tmp_dir,
+                s3_client=self.s3_client
+            )
+            with unittest.mock.patch.object(
+                dataset, 'download_image_from_tissue_index',
+                return_value=True
+            ) as download:
+                results = dataset.download_images_bulk(
+                    [13, 29, 13, 13], 4, tmp_dir / 'bulk'
+                )
+            self.assertEqual(results, {13: True, 29: True})
+            self.assertEqual(
+                sorted(call.args[0] for call in download.call_args_list),
+                [13, 29]
+            )
+
+    def _put_section_image(
+        self, tmp_dir: Path, tissue_index: int, mode: str, **save_kwargs
+    ):
+        """
+        Upload a random downsample_4 TIFF for tissue_index (saved with
+        save_kwargs). Return the tier metadata and the uploaded image.
+        """
+        img_metadata = [img for img in self.section_metadata['section_images']
+                        if img['section_number'] == tissue_index][0]
+        tier_metadata = img_metadata['downsampling']['downsample_4']
+
+        shape = (tier_metadata['image_file_height'],
+                 tier_metadata['image_file_width'])
+        if mode == 'RGB':
+            shape += (3,)
+        rng = np.random.default_rng(tissue_index)
+        tiff = Image.fromarray(
+            rng.integers(0, 256, size=shape, dtype=np.uint8), mode
+        )
+        tiff.save(tmp_dir / 'full.tiff', **save_kwargs)
+        self.s3_client.upload_file(
+            str(tmp_dir / 'full.tiff'),
+            self.bucket_name,
+            'section_data_set_%d/downsample_4/%s'
+            % (self.section_id, img_metadata['image_file_name'])
+        )
+        return (tier_metadata, tiff)
+
+    def _check_cropped_image(self, tiff_name, tier_metadata, tiff):
+        """
+        Check that tiff_name holds the section of tiff described by
+        tier_metadata
+        """
+        self.assertTrue(is_valid_tiff(tiff_name))
+        x0 = tier_metadata['x']
+        y0 = tier_metadata['y']
+        expected = tiff.crop((x0, y0,
+                              x0 + tier_metadata['width'],
+                              y0 + tier_metadata['height']))
+        with Image.open(tiff_name) as img:
+            self.assertEqual(img.size, expected.size)
+            np.testing.assert_array_equal(np.asarray(img),
+                                          np.asarray(expected))
+
+    def test_multi_strip_image_download(self):
+        """
+        Test downloading (and cropping) an uncompressed section image
+        that is stored as many strips, only some of which are read
+        """
+        tissue_index = 13
+        with make_tmp_dir() as tmp_dir:
+            (tier_metadata, tiff) = self._put_section_image(
+                tmp_dir, tissue_index, 'L', tiffinfo={278: 16}
+            )
+
+            dataset = mouse_utils.SectionDataSet(
+                self.section_id,
+                download_directory=tmp_dir,
+                s3_client=self.s3_client
+            )
+            tiff_name = tmp_dir / 'tissue.tiff'
+            res = dataset.download_image_from_tissue_index(
+                tissue_index, 4, tiff_name
+            )
+            self.assertIs(res, True)
+            self._check_cropped_image(tiff_name, tier_metadata, tiff)
+
+    def test_compressed_image_download(self):
+        """
+        Test downloading (and cropping) a compressed section image, which
+        has to be downloaded in full; the bytes read while opening it
+        should be reused rather than downloaded a second time
+        """
+        tissue_index = 29
+        with make_tmp_dir() as tmp_dir:
+            (tier_metadata, tiff) = self._put_section_image(
+                tmp_dir, tissue_index, 'RGB', compression='tiff_lzw'
+            )
+            file_size = (tmp_dir / 'full.tiff').stat().st_size
+
+            dataset = mouse_utils.SectionDataSet(
+                self.section_id,
+                download_directory=tmp_dir,
+                s3_client=self.s3_client,
+                transfer_config=mouse_utils.TransferConfig(
+                    multipart_chunksize=file_size // 5, max_concurrency=3
+                )
+            )
+            dataset.metadata  # download the metadata before counting
+
+            tiff_name = tmp_dir / 'tissue.tiff'
+            with unittest.mock.patch.object(
+                self.s3_client, 'get_object',
+                wraps=self.s3_client.get_object
+            ) as get_object, unittest.mock.patch.object(
+                self.s3_client, 'head_object',
+                wraps=self.s3_client.head_object
+            ) as head_object, unittest.mock.patch.object(
+                mouse_utils, '_RANGE_READ_SIZE', file_size // 4
+            ):
+                res = dataset.download_image_from_tissue_index(
+                    tissue_index, 4, tiff_name
+                )
+            self.assertIs(res, True)
+            self._check_cropped_image(tiff_name, tier_metadata, tiff)
+
+            # every request is for a range of bytes, the start of the file
+            # is only requested once, and apart from any reads made
+            # while parsing the header, no byte is requested twice
+            head_object.assert_not_called()
+            n_bytes = 0
+            n_from_start = 0
+            for call in get_object.call_args_list:
+                (first, last) = call.kwargs['Range'][6:].split('-')
+                n_bytes += min(int(last) + 1, file_size) - int(first)
+                n_from_start += int(first) == 0
+            self.assertEqual(n_from_start, 1)
+            self.assertGreaterEqual(n_bytes, file_size)
+            self.assertLess(n_bytes, file_size + file_size // 4)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,464 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+from pathlib import Path
+
+import boto3
+from botocore.exceptions import ClientError
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+import open_dataset_tools.ivy_gap_utils as ivy_utils
+
+
+@unittest.skipIf(mock_aws is None, 'moto is not installed')
+class MockedS3TestCase(unittest.TestCase):
+    """
+    Tests that run against a small, made-up copy of the
+    allen-ivy-glioblastoma-atlas bucket in moto, so that they need no
+    network access
+    """
+
+    bucket_name = 'allen-ivy-glioblastoma-atlas'
+    section_ids = (101, 102)
+    image_size = (64, 48)
+
+    def setUp(self):
+        env = unittest.mock.patch.dict(os.environ, {
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1'
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        ivy_utils.clear_metadata_cache()
+        self.addCleanup(ivy_utils.clear_metadata_cache)
+
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket=self.bucket_name)
+
+        # the module creates its own (anonymous) client where none is
+        # passed in; use the mocked one instead
+        client_patch = unittest.mock.patch.object(
+            ivy_utils, 'get_public_boto3_client',
+            return_value=self.s3_client
+        )
+        client_patch.start()
+        self.addCleanup(client_patch.stop)
+
+        rng = np.random.default_rng(0)
+        self.images = dict()
+        self.section_metadata = []
+        for section_id in self.section_ids:
+            sub_images = []
+            for sub_image in range(3):
+                sub_image_id = section_id * 10 + sub_image
+                s3_data = dict()
+                for kind in ('image', 'expression'):
+                    key = 'section_%d/sub_image_%d/%s.jpg' % (
+                        section_id, sub_image_id, kind
+                    )
+                    (width, height) = self.image_size
+                    img = Image.fromarray(
+                        rng.integers(0, 256, size=(height, width, 3),
+                                     dtype=np.uint8)
+                    )
+                    buf = io.BytesIO()
+                    img.save(buf, format='JPEG')
+                    self.s3_client.put_object(
+                        Bucket=self.bucket_name, Key=key,
+                        Body=buf.getvalue()
+                    )
+                    self.images[key] = buf.getvalue()
+                    s3_data[kind] = 's3://%s/%s' % (self.bucket_name, key)
+                sub_images.append({
+                    'id': sub_image_id,
+                    'width': width,
+                    'height': height,
+                    's3_data': s3_data
+                })
+            self.section_metadata.append({
+                'section_data_set_id': section_id,
+                'sub_images': sub_images
+            })
+
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key='section_metadata.json',
+            Body=json.dumps(self.section_metadata).encode('utf-8')
+        )
+
+    def test_metadata_cache(self):
+        """
+        Test that the section metadata is only downloaded once, whichever
+        client asks for it, and that the tables returned do not share any
+        state with the cache
+        """
+        with unittest.mock.patch.object(
+            ivy_utils, '_download_s3_bytes',
+            wraps=ivy_utils._download_s3_bytes
+        ) as loader:
+            table = ivy_utils.get_section_metadata(self.s3_client)
+            other_client = boto3.client('s3', region_name='us-east-1')
+            other_table = ivy_utils.get_section_metadata(other_client)
+        self.assertEqual(loader.call_count, 1)
+        self.assertEqual(len(table), len(self.section_ids))
+
+        # modify the nested sub_images of one copy
+        table.at[0, 'sub_images'][0]['width'] = -1
+        table.at[0, 'sub_images'].append({})
+        self.assertEqual(other_table.at[0, 'sub_images'],
+                         self.section_metadata[0]['sub_images'])
+        self.assertEqual(
+            ivy_utils.get_section_metadata(self.s3_client)
+            .at[0, 'sub_images'],
+            self.section_metadata[0]['sub_images']
+        )
+
+    def _image_promise(self, key: str) -> ivy_utils.ImagePromise:
+        (width, height) = self.image_size
+        return ivy_utils.ImagePromise(
+            's3://%s/%s' % (self.bucket_name, key), width, height,
+            s3_client=self.s3_client
+        )
+
+    def _put_image(self, key: str, img: Image.Image, **save_kwargs):
+        buf = io.BytesIO()
+        img.save(buf, **save_kwargs)
+        self.s3_client.put_object(
+            Bucket=self.bucket_name, Key=key, Body=buf.getvalue()
+        )
+        return ivy_utils.ImagePromise(
+            's3://%s/%s' % (self.bucket_name, key), img.width, img.height,
+            s3_client=self.s3_client
+        )
+
+    def test_load_roi(self):
+        """
+        Test cropping an image to a region of interest while loading it
+        """
+        key = sorted(self.images)[0]
+        promise = self._image_promise(key)
+        full = promise.load()
+        self.assertEqual(full.size, self.image_size)
+
+        roi = (5, 7, 45, 37)
+        cropped = promise.load(roi=roi)
+        self.assertEqual(cropped.size, (40, 30))
+        np.testing.assert_array_equal(np.asarray(cropped),
+                                      np.asarray(full.crop(roi)))
+        np.testing.assert_array_equal(promise.load_array(roi=roi),
+                                      np.asarray(cropped))
+
+        with self.assertRaises(ValueError):
+            promise.load(downsample=0)
+
+    def test_load_downsample(self):
+        """
+        Test downsampling an image (or a region of it) while loading it,
+        against cropping and resizing the full resolution image
+        """
+        (y, x) = np.mgrid[0:192, 0:256]
+        pixels = np.stack(
+            [x, y, (x + y) // 2], axis=-1
+        ).astype(np.uint8)
+        img = Image.fromarray(pixels)
+        roi = (32, 16, 224, 176)
+
+        # lossless images are decoded in full, so the results match a
+        # crop and resize exactly
+        promise = self._put_image('gradient.png', img, format='PNG')
+        for (box, downsample) in ((None, 2), (roi, 2), (roi, 3)):
+            with self.subTest(format='PNG', roi=box, downsample=downsample):
+                expected = img.crop(box or (0, 0, 256, 192))
+                expected = expected.resize(
+                    (expected.width // downsample,
+                     expected.height // downsample),
+                    Image.BOX
+                )
+                result = promise.load(roi=box, downsample=downsample)
+                self.assertEqual(result.size, expected.size)
+                np.testing.assert_array_equal(np.asarray(result),
+                                              np.asarray(expected))
+
+        # JPEGs are scaled while they are decoded, which only
+        # approximately matches a resize of the full image
+        promise = self._put_image('gradient.jpg', img, format='JPEG',
+                                  quality=95)
+        full = promise.load()
+        for (box, downsample) in ((None, 2), (roi, 4)):
+            with self.subTest(format='JPEG', roi=box, downsample=downsample):
+                expected = full.crop(box or (0, 0, 256, 192))
+                expected = expected.resize(
+                    (expected.width // downsample,
+                     expected.height // downsample),
+                    Image.BOX
+                )
+                result = promise.load(roi=box, downsample=downsample)
+                self.assertEqual(result.size, expected.size)
+                diff = np.abs(np.asarray(result, dtype=float)
+                              - np.asarray(expected, dtype=float))
+                self.assertLess(diff.mean(), 2.0)
+
+    def test_head(self):
+        """
+        Test reading an image's header, including when it does not fit in
+        the first range that is fetched
+        """
+        key = sorted(self.images)[0]
+        promise = self._image_promise(key)
+        expected = {
+            'format': 'JPEG',
+            'mode': 'RGB',
+            'width': self.image_size[0],
+            'height': self.image_size[1]
+        }
+        self.assertEqual(promise.head(), expected)
+        with unittest.mock.patch.object(ivy_utils, '_HEADER_RANGE_SIZE', 8):
+            self.assertEqual(promise.head(), expected)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            (tmp_dir / key).parent.mkdir(parents=True)
+            (tmp_dir / key).write_bytes(self.images[key])
+            local_promise = ivy_utils.ImagePromise(
+                's3://%s/%s' % (self.bucket_name, key),
+                *self.image_size,
+                local_save_directory=tmp_dir
+            )
+            self.assertEqual(local_promise.head(), expected)
+
+    def test_load_many(self):
+        """
+        Test that load_many returns the images in the order of the
+        promises passed to it
+        """
+        keys = sorted(self.images)
+        keys = keys[::2] + keys[1::2]
+        promises = [self._image_promise(key) for key in keys]
+        images = ivy_utils.ImagePromise.load_many(promises, max_workers=4)
+        self.assertEqual(len(images), len(keys))
+        for (key, img) in zip(keys, images):
+            expected = Image.open(io.BytesIO(self.images[key]))
+            np.testing.assert_array_equal(np.asarray(img),
+                                          np.asarray(expected))
+
+        self.assertEqual(ivy_utils.ImagePromise.load_many([]), [])
+
+    def test_section_image_loader(self):
+        """
+        Test building a section's image table, whole and in chunks
+        """
+        table = ivy_utils.get_section_metadata(self.s3_client)
+        section_id = self.section_ids[1]
+        sub_images = self.section_metadata[1]['sub_images']
+
+        images = ivy_utils.section_image_loader(table, section_id)
+        self.assertEqual(list(images.columns),
+                         ['id', 'width', 'height', 'image', 'expression'])
+        self.assertEqual(list(images['id']),
+                         [img['id'] for img in sub_images])
+        self.assertIsInstance(images.at[0, 'image'], ivy_utils.ImagePromise)
+
+        chunks = list(
+            ivy_utils.section_image_loader(table, section_id, chunksize=2)
+        )
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        chunked = pd.concat(chunks)
+        self.assertEqual(list(chunked.index), list(images.index))
+        self.assertEqual(list(chunked['id']), list(images['id']))
+        self.assertEqual(list(chunked.columns), list(images.columns))
+
+    def test_section_image_loader_no_images(self):
+        """
+        Test the image table of a section that has no images
+        """
+        table = ivy_utils.get_section_metadata(self.s3_client)
+        table.at[0, 'sub_images'] = []
+        section_id = self.section_ids[0]
+
+        images = ivy_utils.section_image_loader(table, section_id)
+        self.assertEqual(len(images), 0)
+        self.assertEqual(list(images.columns),
+                         ['id', 'width', 'height', 'image', 'expression'])
+        self.assertEqual(
+            list(ivy_utils.section_image_loader(table, section_id,
+                                                chunksize=2)),
+            []
+        )
+
+        # sections whose sub_images are missing (NaN) are skipped when
+        # working out the columns
+        table.at[1, 'sub_images'] = np.nan
+        table.loc[2] = table.loc[1]
+        table.at[2, 'sub_images'] = self.section_metadata[1]['sub_images']
+        self.assertEqual(ivy_utils._section_image_columns(table),
+                         ['id', 'width', 'height', 'image', 'expression'])
+
+    def test_local_section_metadata_loader(self):
+        """
+        Test downloading the section metadata to a local directory with a
+        filter on section_data_set_id, then reloading all of it from the
+        cached copy
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir) / 'ivy_gap'
+            section_id = self.section_ids[1]
+
+            filtered = ivy_utils.local_section_metadata_loader(
+                tmp_dir, section_data_set_ids=[section_id]
+            )
+            self.assertEqual(list(filtered['section_data_set_id']),
+                             [section_id])
+            self.assertEqual(filtered.at[0, 'sub_images'],
+                             self.section_metadata[1]['sub_images'])
+            self.assertTrue((tmp_dir / 'section_metadata.jsonl').is_file())
+
+            # the cached copy holds every section, not just the ones
+            # selected when it was downloaded
+            with unittest.mock.patch.object(
+                self.s3_client, 'get_object',
+                wraps=self.s3_client.get_object
+            ) as get_object:
+                full = ivy_utils.local_section_metadata_loader(tmp_dir)
+            get_object.assert_not_called()
+            self.assertEqual(list(full['section_data_set_id']),
+                             list(self.section_ids))
+            self.assertEqual(list(full['sub_images']),
+                             [section['sub_images']
+                              for section in self.section_metadata])
+
+            # filters are applied when reading the cached copy too
+            with unittest.mock.patch.object(
+                ivy_utils, '_JSON_LINES_CHUNKSIZE', 1
+            ):
+                refiltered = ivy_utils.local_section_metadata_loader(
+                    tmp_dir, section_data_set_ids=[section_id]
+                )
+            self.assertEqual(list(refiltered['section_data_set_id']),
+                             [section_id])
+            self.assertEqual(list(refiltered.index), [0])
+
+    def test_local_section_metadata_loader_old_cache(self):
+        """
+        Test that a section_metadata.json cached by earlier versions is
+        converted rather than downloaded again, and that an empty cache
+        gives an empty table
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            pd.DataFrame(self.section_metadata).to_json(
+                tmp_dir / 'section_metadata.json', orient='records', indent=4
+            )
+            with unittest.mock.patch.object(
+                ivy_utils, 'get_section_metadata'
+            ) as get_section_metadata:
+                table = ivy_utils.local_section_metadata_loader(tmp_dir)
+                cached = ivy_utils.local_section_metadata_loader(tmp_dir)
+            get_section_metadata.assert_not_called()
+            self.assertEqual(list(table['section_data_set_id']),
+                             list(self.section_ids))
+            self.assertEqual(list(cached['sub_images']),
+                             list(table['sub_images']))
+
+            (tmp_dir / 'section_metadata.jsonl').write_bytes(b'')
+            self.assertEqual(
+                len(ivy_utils.local_section_metadata_loader(tmp_dir)), 0
+            )
+
+    def test_pixel_limit(self):
+        """
+        Test that images larger than Pillow's decompression bomb limit can
+        be loaded, but that the limit is left in place for everything else
+        """
+        key = sorted(self.images)[0]
+        with unittest.mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 100):
+            promise = self._image_promise(key)
+            self.assertEqual(promise.load().size, self.image_size)
+            self.assertEqual(promise.load(roi=(0, 0, 40, 30)).size, (40, 30))
+            self.assertEqual(promise.head()['width'], self.image_size[0])
+            self.assertEqual(Image.MAX_IMAGE_PIXELS, 100)
+            with self.assertRaises(Image.DecompressionBombError):
+                Image.open(io.BytesIO(self.images[key]))
+
+    def test_section_image_downloader(self):
+        """
+        Test downloading the images of a section, then that a second run
+        skips the images that are already there unless clobber=True
+        """
+        section_id = self.section_ids[0]
+        keys = sorted(key for key in self.images
+                      if key.startswith('section_%d/' % section_id))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            ivy_utils.section_image_downloader(
+                tmp_dir, section_id, max_workers=4
+            )
+            for key in keys:
+                self.assertEqual((tmp_dir / key).read_bytes(),
+                                 self.images[key])
+            self.assertEqual(list(tmp_dir.rglob('*.part')), [])
+
+            # mark one of the files so that it can be told apart from a
+            # fresh download
+            marked = tmp_dir / keys[0]
+            marked.write_bytes(b'already here')
+
+            with unittest.mock.patch.object(
+                self.s3_client, 'download_fileobj',
+                wraps=self.s3_client.download_fileobj
+            ) as download:
+                ivy_utils.section_image_downloader(
+                    tmp_dir, section_id, max_workers=4
+                )
+            download.assert_not_called()
+            self.assertEqual(marked.read_bytes(), b'already here')
+
+            with unittest.mock.patch.object(
+                self.s3_client, 'download_fileobj',
+                wraps=self.s3_client.download_fileobj
+            ) as download:
+                ivy_utils.section_image_downloader(
+                    tmp_dir, section_id, max_workers=4, clobber=True
+                )
+            self.assertEqual(download.call_count, len(keys))
+            for key in keys:
+                self.assertEqual((tmp_dir / key).read_bytes(),
+                                 self.images[key])
+
+    def test_section_image_downloader_failure(self):
+        """
+        Test that a failed download leaves neither the image nor a
+        partial file behind
+        """
+        section_id = self.section_ids[0]
+        keys = sorted(key for key in self.images
+                      if key.startswith('section_%d/' % section_id))
+        self.s3_client.delete_object(Bucket=self.bucket_name, Key=keys[0])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            with self.assertRaises(ClientError):
+                ivy_utils.section_image_downloader(
+                    tmp_dir, section_id, max_workers=1
+                )
+            self.assertFalse((tmp_dir / keys[0]).exists())
+            self.assertEqual(list(tmp_dir.rglob('*.part')), [])
+
+
+if __name__ == "__main__":
+    unittest.main()